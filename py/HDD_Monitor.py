@@ -1,16 +1,71 @@
 #!/usr/bin/python
 from subprocess import Popen, PIPE
 from re import compile as re_compile
-from os.path import exists
+from os import fstat, listdir, rename, makedirs
+from os.path import exists, isdir, join
+from json import load, dump
+from mmap import mmap
+from struct import Struct, error as struct_error
+from time import time, sleep
+from datetime import datetime
+from threading import Timer, Lock, Condition, Thread
+from heapq import heapify, heappush, heappop
+from select import poll, POLLPRI, POLLERR
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from multiprocessing import TimeoutError
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn, TCPServer, BaseRequestHandler
+from socket import create_connection, gethostname, error as socket_error
+from zlib import compress, decompress, error as zlib_error
+from json import dumps, loads
+from ctypes import CDLL, Structure, byref, addressof, get_errno, create_string_buffer, \
+    c_int, c_uint, c_ubyte, c_ushort, c_void_p
+from os import open as os_open, close as os_close, strerror, O_RDONLY, O_NONBLOCK
+from os.path import basename
+from errno import ENOTTY, EINVAL, EOPNOTSUPP, EPERM, EACCES
 
 MDSTAT_PATH = "/proc/mdstat"
+SYS_BLOCK_PATH = "/sys/block"
 
+def read_sys(*path):
+    try:
+        f = open(join(*path))
+        try:
+            return f.read().strip()
+        finally:
+            f.close()
+    except IOError:
+        return None
+
+# smartctl -i fields that never change for a disk, cached by WWN
+IDENTITY_KEYS = ('Model Family', 'Device Model', 'Model Number', 'Serial Number', 'LU WWN Device Id',
+    'Firmware Version', 'User Capacity')
+
+# returncode is None if it's killed for taking longer than timeout seconds
 def call(*args, **kwargs):
+    timeout = kwargs.pop('timeout', None)
     kwargs['stdout'] = PIPE
     kwargs['stderr'] = PIPE
     p = Popen(*args, **kwargs)
-    out, err = p.communicate()
-    return p.returncode, out, err
+    timed_out = []
+    def kill():
+        timed_out.append(True)
+        try:
+            p.kill()
+        except OSError:
+            pass
+    timer = None
+    if timeout is not None:
+        timer = Timer(timeout, kill)
+        timer.daemon = True
+        timer.start()
+    try:
+        out, err = p.communicate()
+    finally:
+        if timer is not None:
+            timer.cancel()
+    return None if timed_out else p.returncode, out, err
 
 si_prefixes = ["", "K", "M", "G", "T"]
 def format_size(d):
@@ -20,22 +75,748 @@ def format_size(d):
         i += 1
     return "%s%s" % (("%d" % d if ("%.1f" % d)[-1] == "0" else "%.1f" % d), si_prefixes[i])
 
+# the attributes report_one() shows, kept in SmartHistory in this order
+HISTORY_ATTRS = ('c2', '05', '09', '0a', 'c1', 'c4', 'c5', 'c6')
+
+class SmartHistory(object):
+    # fixed size per disk ring buffers of (time, HISTORY_ATTRS...) samples, packed
+    # with struct straight into a memory-mapped file so they survive restarts
+    # file: header, then max_disks slots of (key, head, count, capacity records)
+    header_struct = Struct('<4sIIII')
+    slot_struct = Struct('<64sII')
+    record_struct = Struct('<d%dq' % len(HISTORY_ATTRS))
+    magic = 'HDDH'
+    version = 1
+    missing = -1
+
+    def __init__(self, path, capacity = 1024, max_disks = 128):
+        self.capacity = capacity
+        self.max_disks = max_disks
+        self.slot_size = self.slot_struct.size + capacity * self.record_struct.size
+        size = self.header_struct.size + max_disks * self.slot_size
+        header = (self.magic, self.version, max_disks, capacity, len(HISTORY_ATTRS))
+        self.file = open(path, exists(path) and 'r+b' or 'w+b')
+        fresh = True
+        if fstat(self.file.fileno()).st_size == size:
+            fresh = self.header_struct.unpack(self.file.read(self.header_struct.size)) != header
+        self.file.truncate(0 if fresh else size)
+        self.file.truncate(size)
+        self.map = mmap(self.file.fileno(), size)
+        if fresh:
+            self.header_struct.pack_into(self.map, 0, *header)
+        self.lock = Lock()
+        # key -> slot number
+        self.slots = {}
+        for i in xrange(max_disks):
+            key = self.slot_struct.unpack_from(self.map, self.slot_offset(i))[0].rstrip('\0')
+            if key:
+                self.slots[key] = i
+
+    def slot_offset(self, i):
+        return self.header_struct.size + i * self.slot_size
+
+    def slot(self, key):
+        # None if the file is full
+        with self.lock:
+            i = self.slots.get(key)
+            if i is None and len(self.slots) < self.max_disks:
+                i = self.slots[key] = len(self.slots)
+                self.slot_struct.pack_into(self.map, self.slot_offset(i), key[:64], 0, 0)
+            return i
+
+    def append(self, key, t, info):
+        i = self.slot(key)
+        if i is None:
+            return
+        offset = self.slot_offset(i)
+        _, head, count = self.slot_struct.unpack_from(self.map, offset)
+        self.record_struct.pack_into(self.map,
+            offset + self.slot_struct.size + head * self.record_struct.size,
+            t, *[info.get(a, self.missing) for a in HISTORY_ATTRS])
+        self.slot_struct.pack_into(self.map, offset, key[:64],
+            (head + 1) % self.capacity, min(count + 1, self.capacity))
+
+    def samples(self, key, since = 0):
+        # yields (time, values) from the newest back to since
+        i = self.slots.get(key)
+        if i is None:
+            return
+        offset = self.slot_offset(i)
+        _, head, count = self.slot_struct.unpack_from(self.map, offset)
+        offset += self.slot_struct.size
+        for n in xrange(count):
+            sample = self.record_struct.unpack_from(self.map,
+                offset + (head - n - 1) % self.capacity * self.record_struct.size)
+            if sample[0] < since:
+                return
+            yield sample[0], sample[1:]
+
+    def trend(self, key, window, now = None, min_span = 3600):
+        # {attr: (delta, per hour)} between the oldest and newest samples in
+        # window, per hour is None until they're min_span seconds apart, a
+        # degree over a few seconds isn't a rate worth showing
+        newest = oldest = None
+        for sample in self.samples(key, (now or time()) - window):
+            if newest is None:
+                newest = sample
+            oldest = sample
+        ret = {}
+        if newest is None or newest[0] == oldest[0]:
+            return ret
+        span = newest[0] - oldest[0]
+        for a, new, old in zip(HISTORY_ATTRS, newest[1], oldest[1]):
+            if new != self.missing and old != self.missing:
+                ret[a] = (new - old, (new - old) * 3600. / span if span >= min_span else None)
+        return ret
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+DISKSTATS_PATH = "/proc/diskstats"
+
+class DiskStats(object):
+    # i/o rates from the deltas between two reads of /proc/diskstats, which is
+    # one cheap read for every disk in the system
+    def __init__(self, path = DISKSTATS_PATH):
+        self.path = path
+        self.last = None
+        # name -> {"read_bps", "write_bps", "iops", "await", "util"}
+        self.rates = {}
+
+    def read(self):
+        # name -> (reads, sectors read, ms reading, writes, sectors written, ms writing, ms doing i/o)
+        stats = {}
+        f = open(self.path)
+        try:
+            for l in f:
+                l = l.split()
+                if len(l) >= 14:
+                    stats[l[2]] = tuple(int(l[i]) for i in (3, 5, 6, 7, 9, 10, 12))
+        finally:
+            f.close()
+        return stats
+
+    def sample(self, min_interval = 1):
+        # rates since the last sample, waits to make that at least min_interval
+        # seconds, numbers over a few ms are just noise
+        if self.last is not None and time() - self.last[0] < min_interval:
+            sleep(min_interval - (time() - self.last[0]))
+        now, stats = time(), self.read()
+        if self.last is not None:
+            dt = now - self.last[0]
+            self.rates = {}
+            for name, new in stats.items():
+                old = self.last[1].get(name)
+                if old is None:
+                    continue
+                d = [n - o for n, o in zip(new, old)]
+                ios = d[0] + d[3]
+                self.rates[name] = {
+                    "read_bps": d[1] * 512 / dt,
+                    "write_bps": d[4] * 512 / dt,
+                    "iops": ios / dt,
+                    # ms per i/o, queueing included, like iostat's await
+                    "await": ios and float(d[2] + d[5]) / ios or 0.,
+                    "util": min(100., d[6] / dt / 10),
+                }
+        self.last = now, stats
+        return self.rates
+
+def array_stats(hdds, rates, slow_factor = 2., slow_min_await = 10.):
+    # md -> {"read_bps", "write_bps", "iops", "await", "util", "slow": [members]}
+    # a member is slow when its await is slow_factor times the array's median
+    arrays = {}
+    for hdd, r in hdds.items():
+        if "mdadm" in r and hdd in rates:
+            arrays.setdefault(r["mdadm"], []).append(hdd)
+    ret = {}
+    for md, members in arrays.items():
+        member_rates = [rates[m] for m in members]
+        awaits = sorted(r["await"] for r in member_rates)
+        # the lower median, so one slow disk out of two still stands out
+        median = awaits[(len(awaits) - 1) // 2]
+        ret[md] = {
+            "read_bps": sum(r["read_bps"] for r in member_rates),
+            "write_bps": sum(r["write_bps"] for r in member_rates),
+            "iops": sum(r["iops"] for r in member_rates),
+            "await": awaits[-1],
+            "util": max(r["util"] for r in member_rates),
+            "slow": sorted(m for m in members if len(members) > 1 and
+                rates[m]["await"] >= slow_min_await and rates[m]["await"] > median * slow_factor),
+        }
+    return ret
+
+smart_attribute_pattern = re_compile(r"^[0-9a-f]{2}$")
+
+def metric_label(v):
+    return '"%s"' % str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def metric(name, labels, value):
+    return '%s{%s} %s\n' % (name, ','.join('%s=%s' % (k, metric_label(v)) for k, v in labels), value)
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    # server.hddm is the HDD_Monitor, scrapes never touch a disk
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.hddm.metrics(time())
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+# agent protocol: the aggregator sends AGENT_REQUEST, the agent answers with a
+# 4 byte length then zlib'd json, as many times as asked on one connection
+AGENT_REQUEST = 'S'
+agent_length = Struct('>I')
+# a snapshot is a few KB per disk, anything near this is not an agent talking
+AGENT_MAX_LENGTH = 16 << 20
+
+class AgentServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class AgentHandler(BaseRequestHandler):
+    # server.hddm is the HDD_Monitor, like MetricsHandler
+    def handle(self):
+        while self.request.recv(1) == AGENT_REQUEST:
+            blob = self.server.hddm.agent_snapshot
+            self.request.sendall(agent_length.pack(len(blob)) + blob)
+
+def recv_exactly(sock, n):
+    chunks = []
+    while n > 0:
+        chunk = sock.recv(n)
+        if not chunk:
+            raise EOFError('connection closed')
+        chunks.append(chunk)
+        n -= len(chunk)
+    return ''.join(chunks)
+
+def report_on_list(hdds):
+    standby = 0
+    temp_sum = 0.
+    temp_count = 0
+    temp_max = 0
+    for d in hdds:
+        if d.get('STANDBY'):
+            standby += 1
+        else:
+            # Temperature_Celsius
+            temp = d.get('c2')
+            if temp is not None:
+                temp_sum += temp
+                temp_count += 1
+                if temp > temp_max:
+                    temp_max = temp
+    return 'Active/Total: %d/%d, Temp: %s' % (
+        len(hdds) - standby, len(hdds),
+        (temp_count > 0) and ('Avg: %.1f, Max: %.1f' % (temp_sum / temp_count, temp_max)) or '-N/A-')
+
+def report_by_model(hdds):
+    models = {}
+    for hdd in hdds:
+        model_name = hdd.get('Device Model', '-N/A-')
+        model = models.get(model_name)
+        if model is None:
+            models[model_name] = [hdd]
+        else:
+            model.append(hdd)
+    report = []
+    for model_name in models:
+        report.append('%s: %s' % (model_name, report_on_list(models[model_name])))
+    report.append('===')
+    report.append('Total: ' + report_on_list(hdds))
+    return '\n'.join(report)
+
+class Fleet(object):
+    # the aggregator, agents are "host:port" of HDD_Monitors started with agent_port
+    def __init__(self, agents, timeout = 10):
+        self.agents = agents
+        self.timeout = timeout
+        # one connection per agent, kept open between fetches
+        self.conns = {}
+        # agent -> last snapshot, or the error if it couldn't be reached
+        self.snapshots = {}
+        self.errors = {}
+        self.pool = ThreadPool(max(1, len(agents)))
+
+    def connect(self, agent):
+        host, _, port = agent.rpartition(':')
+        return create_connection((host, int(port)), self.timeout)
+
+    def fetch_one(self, agent):
+        # a kept connection may have gone stale, so a failure on one gets a
+        # second try on a new connection
+        for retry in (False, True):
+            sock = self.conns.pop(agent, None)
+            fresh = sock is None
+            try:
+                if fresh:
+                    sock = self.connect(agent)
+                sock.sendall(AGENT_REQUEST)
+                n = agent_length.unpack(recv_exactly(sock, agent_length.size))[0]
+                if n > AGENT_MAX_LENGTH:
+                    raise ValueError('snapshot of %d bytes, more than %d' % (n, AGENT_MAX_LENGTH))
+                snapshot = loads(decompress(recv_exactly(sock, n)))
+                self.conns[agent] = sock
+                return snapshot
+            except (socket_error, EOFError):
+                if sock is not None:
+                    sock.close()
+                if fresh or retry:
+                    raise
+            except (zlib_error, struct_error, ValueError):
+                # whatever is left on this connection can't be trusted either
+                if sock is not None:
+                    sock.close()
+                raise
+
+    def fetch(self):
+        # all agents at once, a slow one only costs its own timeout
+        def fetch_one(agent):
+            try:
+                return agent, self.fetch_one(agent), None
+            except (socket_error, EOFError, ValueError, zlib_error, struct_error), e:
+                return agent, None, e
+        for agent, snapshot, e in self.pool.map(fetch_one, self.agents):
+            if e is None:
+                self.snapshots[agent] = snapshot
+                self.errors.pop(agent, None)
+            else:
+                self.errors[agent] = e
+
+    def report(self):
+        now = time()
+        report = []
+        hdds = []
+        for agent in self.agents:
+            s = self.snapshots.get(agent)
+            if agent in self.errors:
+                report.append('%s: unreachable, %s%s' % (agent, self.errors[agent],
+                    s and ', last seen %ds ago' % (now - s['time']) or ''))
+            if s is None:
+                continue
+            if agent not in self.errors:
+                report.append('%s (%s): %s, %ds old' % (agent, s['host'],
+                    report_on_list(s['hdds']), now - s['time']))
+            hdds.extend(s['hdds'])
+            for md in s['md']:
+                report.append('%s %s' % (s['host'], md))
+        report.append('===')
+        report.append(report_by_model(hdds))
+        return '\n'.join(report)
+
+mdstat_member_pattern = re_compile(r"^(\S+)\[\d+\]((\(\w\))*)$")
+mdstat_status_pattern = re_compile(r"\[(\d+)/(\d+)\] \[([U_]+)\]")
+mdstat_sync_pattern = re_compile(r"(resync|recovery|check|reshape|repair)\s*=\s*([\d.]+)%"
+    r"(.*finish=([\d.]+)min)?(.*speed=(\d+)K/sec)?")
+mdstat_sync_pending_pattern = re_compile(r"(resync|recovery|check|reshape|repair)\s*=\s*(DELAYED|PENDING)")
+
+def parse_mdstat(text):
+    # md -> {"state", "level", "members": {name: flags}, "raid_disks", "active_disks",
+    # "degraded", "sync": None or (action, percent, finish minutes, speed KB/s)}
+    arrays = {}
+    md = None
+    for l in text.split("\n"):
+        if not l.strip():
+            md = None
+            continue
+        if l[0] != " ":
+            name, sep, rest = l.partition(" : ")
+            if not sep or not name.startswith("md"):
+                continue
+            tokens = rest.split()
+            md = arrays[name] = {"state": tokens[0], "level": None, "members": {},
+                "raid_disks": None, "active_disks": None, "degraded": False, "sync": None}
+            for t in tokens[1:]:
+                m = mdstat_member_pattern.match(t)
+                if m is not None:
+                    md["members"][m.group(1)] = m.group(2).replace("(", "").replace(")", "")
+                elif not t.startswith("("):
+                    md["level"] = t
+        elif md is not None:
+            m = mdstat_status_pattern.search(l)
+            if m is not None:
+                md["raid_disks"], md["active_disks"] = int(m.group(1)), int(m.group(2))
+                md["degraded"] = "_" in m.group(3)
+            m = mdstat_sync_pattern.search(l)
+            if m is not None:
+                md["sync"] = (m.group(1), float(m.group(2)),
+                    m.group(4) and float(m.group(4)), m.group(6) and int(m.group(6)))
+            m = mdstat_sync_pending_pattern.search(l)
+            if m is not None:
+                md["sync"] = (m.group(1) + " " + m.group(2).lower(), 0., None, None)
+    return arrays
+
+def mdstat_events(old, new):
+    # what changed between two parse_mdstat()s, as messages
+    events = []
+    for name in sorted(set(old) | set(new)):
+        o, n = old.get(name), new.get(name)
+        if o is None:
+            events.append("%s: appeared, %s %s" % (name, n["state"], n["level"] or ""))
+            o = {"members": {}, "degraded": False, "sync": None, "state": n["state"]}
+        if n is None:
+            events.append("%s: gone" % name)
+            continue
+        if o["state"] != n["state"]:
+            events.append("%s: %s" % (name, n["state"]))
+        for member in sorted(set(o["members"]) | set(n["members"])):
+            if member not in n["members"]:
+                events.append("%s: %s removed" % (name, member))
+            elif member not in o["members"]:
+                events.append("%s: %s added%s" % (name, member,
+                    "F" in n["members"][member] and ", failed" or ""))
+            elif "F" in n["members"][member] and "F" not in o["members"][member]:
+                events.append("%s: %s failed" % (name, member))
+        if n["degraded"] != o["degraded"]:
+            events.append(n["degraded"] and "%s: degraded, %d/%d disks" % (name, n["active_disks"], n["raid_disks"])
+                or "%s: no longer degraded" % name)
+        old_sync, new_sync = o["sync"] and o["sync"][0], n["sync"] and n["sync"][0]
+        if old_sync != new_sync:
+            if old_sync:
+                events.append("%s: %s finished" % (name, old_sync))
+            if new_sync:
+                events.append("%s: %s started" % (name, new_sync))
+    return events
+
+class MdstatWatcher(object):
+    # /proc/mdstat is re-parsed when the kernel signals a change on it, which
+    # poll() sees as POLLPRI|POLLERR, nothing is read on a timer
+    def __init__(self, path = MDSTAT_PATH, max_events = 100):
+        self.path = path
+        self.file = open(path)
+        self.lock = Lock()
+        self.arrays = {}
+        # (time, message)
+        self.events = deque(maxlen = max_events)
+        self.watching = False
+        # the state at start is the baseline, not events
+        self.arrays = parse_mdstat(self.file.read())
+
+    def refresh(self):
+        # re-parse now, this also re-arms the kernel's change notification
+        with self.lock:
+            self.file.seek(0)
+            arrays = parse_mdstat(self.file.read())
+            now = time()
+            for e in mdstat_events(self.arrays, arrays):
+                self.events.append((now, e))
+            self.arrays = arrays
+
+    def syncing(self):
+        return any(md["sync"] for md in self.arrays.values())
+
+    def watch_forever(self):
+        p = poll()
+        p.register(self.file.fileno(), POLLPRI | POLLERR)
+        self.watching = True
+        while True:
+            p.poll()
+            self.refresh()
+
+    def start(self):
+        t = Thread(target = self.watch_forever)
+        t.daemon = True
+        t.start()
+        return t
+
+    def summary(self, md):
+        a = self.arrays[md]
+        failed = sorted(m for m, flags in a["members"].items() if "F" in flags)
+        ret = "%s: %s %s" % (md, a["state"], a["level"] or "")
+        if a["raid_disks"] is not None:
+            ret += " %d/%d" % (a["active_disks"], a["raid_disks"])
+        if a["degraded"]:
+            ret += ", DEGRADED"
+        if failed:
+            ret += ", failed: " + " ".join(failed)
+        if a["sync"]:
+            action, percent, finish, speed = a["sync"]
+            ret += ", %s %.1f%%" % (action, percent)
+            if speed:
+                ret += " at %.1fMB/s" % (speed / 1000.)
+            if finish:
+                ret += ", ETA %dh%02dm" % divmod(int(finish), 60)
+        return ret
+
 mdstat_device_pattern = re_compile(r"([a-z]+)\d*\[\d+\]")
 
+# ATA commands through the SCSI generic ioctl, what smartctl does, minus the fork
+SG_IO = 0x2285
+SG_DXFER_NONE = -1
+SG_DXFER_FROM_DEV = -3
+ATA_IDENTIFY = 0xec
+ATA_SMART = 0xb0
+ATA_SMART_READ_DATA = 0xd0
+ATA_CHECK_POWER_MODE = 0xe5
+
+class sg_io_hdr(Structure):
+    _fields_ = [
+        ('interface_id', c_int),
+        ('dxfer_direction', c_int),
+        ('cmd_len', c_ubyte),
+        ('mx_sb_len', c_ubyte),
+        ('iovec_count', c_ushort),
+        ('dxfer_len', c_uint),
+        ('dxferp', c_void_p),
+        ('cmdp', c_void_p),
+        ('sbp', c_void_p),
+        ('timeout', c_uint),
+        ('flags', c_uint),
+        ('pack_id', c_int),
+        ('usr_ptr', c_void_p),
+        ('status', c_ubyte),
+        ('masked_status', c_ubyte),
+        ('msg_status', c_ubyte),
+        ('sb_len_wr', c_ubyte),
+        ('host_status', c_ushort),
+        ('driver_status', c_ushort),
+        ('resid', c_int),
+        ('duration', c_uint),
+        ('info', c_uint),
+    ]
+
+# SG_IO errors that won't go away by trying again
+SG_IO_UNSUPPORTED = (ENOTTY, EINVAL, EOPNOTSUPP, EPERM, EACCES)
+
+class SgIo(object):
+    # cdb -> (data, sense, scsi status), raises IOError/OSError when the
+    # device can't be opened or doesn't take the ioctl
+    def __init__(self):
+        self.libc = CDLL(None, use_errno = True)
+
+    def command(self, device, cdb, length, timeout):
+        data = create_string_buffer(length)
+        sense = create_string_buffer(32)
+        cmd = create_string_buffer(cdb, len(cdb))
+        hdr = sg_io_hdr(interface_id = ord('S'),
+            dxfer_direction = length and SG_DXFER_FROM_DEV or SG_DXFER_NONE,
+            cmd_len = len(cdb), mx_sb_len = len(sense), dxfer_len = length,
+            dxferp = length and c_void_p(addressof(data)) or None,
+            cmdp = c_void_p(addressof(cmd)), sbp = c_void_p(addressof(sense)),
+            timeout = int(timeout * 1000))
+        fd = os_open(device, O_RDONLY | O_NONBLOCK)
+        try:
+            if self.libc.ioctl(fd, SG_IO, byref(hdr)) < 0:
+                e = get_errno()
+                raise IOError(e, strerror(e), device)
+        finally:
+            os_close(fd)
+        if hdr.host_status or (hdr.driver_status & 0xf) not in (0, 8):
+            # 8 is DRIVER_SENSE, there's sense data, which is fine
+            raise IOError('SG_IO failed on %s, host %d, driver %d' % (device, hdr.host_status, hdr.driver_status))
+        return data.raw[:length - hdr.resid], sense.raw[:hdr.sb_len_wr], hdr.status
+
+class FakeSgIo(object):
+    # a stand-in for disks that aren't there: path/<name>/identify and smart
+    # are the 512 byte blocks the disk would return, path/<name>/power is
+    # "standby" or anything else, see fake_disk()
+    def __init__(self, path):
+        self.path = path
+
+    def command(self, device, cdb, length, timeout):
+        disk = join(self.path, basename(device))
+        if not isdir(disk):
+            raise IOError(2, 'No such device', device)
+        command = ord(cdb[14])
+        if command == ATA_CHECK_POWER_MODE:
+            count = 0xff
+            if read_sys(disk, 'power') == 'standby':
+                count = 0
+            # descriptor sense with the ATA status return descriptor
+            return '', '\x72\x01\x1d\x00\x00\x00\x00\x0e\x09\x0c\x00\x00\x00' + chr(count) + '\x00' * 7 + '\x50', 2
+        name = {ATA_IDENTIFY: 'identify', ATA_SMART: 'smart'}.get(command)
+        if name is None:
+            raise IOError(22, 'Invalid argument', device)
+        f = open(join(disk, name), 'rb')
+        try:
+            return f.read(length), '', 0
+        finally:
+            f.close()
+
+def ata_command(sg, device, command, features = 0, lba_mid = 0, lba_high = 0, data = False, timeout = 10):
+    # ATA PASS-THROUGH (16), PIO data-in of one sector or non-data, returns
+    # (data, count register or None)
+    cdb = [0x85,
+        data and 4 << 1 or 3 << 1,
+        # one 512 byte block from the device, or ask for the registers back
+        data and 0x0e or 0x20,
+        0, features, 0, data and 1 or 0, 0, 0, 0, lba_mid, 0, lba_high, 0, command, 0]
+    out, sense, status = sg.command(device, ''.join(map(chr, cdb)), data and 512 or 0, timeout)
+    regs = None
+    if len(sense) >= 22 and ord(sense[0]) & 0x7f == 0x72 and ord(sense[8]) == 0x09:
+        # error, count, status from the ATA status return descriptor
+        regs = ord(sense[11]), ord(sense[13]), ord(sense[21])
+    elif len(sense) >= 7 and ord(sense[0]) & 0x7f == 0x70:
+        regs = ord(sense[3]), ord(sense[6]), ord(sense[4])
+    if regs is not None and regs[2] & 0x01:
+        raise IOError('ATA command 0x%02x failed on %s, error 0x%02x' % (command, device, regs[0]))
+    if regs is None and status != 0:
+        raise IOError('ATA command 0x%02x failed on %s, SCSI status 0x%02x' % (command, device, status))
+    if data and len(out) != 512:
+        raise IOError('ATA command 0x%02x on %s returned %d bytes' % (command, device, len(out)))
+    return out, regs and regs[1]
+
+def ata_string(block, first, last):
+    # words first to last, two characters each, the wrong way round
+    return ''.join(block[i + 1] + block[i] for i in range(first * 2, last * 2 + 2, 2)).strip()
+
+def ata_identity(block):
+    identity = {
+        'Serial Number': ata_string(block, 10, 19),
+        'Firmware Version': ata_string(block, 23, 26),
+        'Device Model': ata_string(block, 27, 46),
+    }
+    words = Struct('<256H').unpack(block)
+    if words[87] & 0xc100 == 0x4100:
+        wwn = words[108] << 48 | words[109] << 32 | words[110] << 16 | words[111]
+        # like smartctl: NAA, OUI, ID
+        identity['LU WWN Device Id'] = '%x %06x %09x' % (wwn >> 60, wwn >> 36 & 0xffffff, wwn & 0xfffffffff)
+    return identity
+
+# id, flags, value, worst, raw and a reserved byte
+smart_entry = Struct('<BHBB6sx')
+# raw bits smartctl shows by default, the rest of raw packs other values:
+# temperatures (tempminmax), spin up time (raw16(avg16)), reallocated
+# sectors/events (raw16(raw16)), power on hours (raw24(raw8))
+SMART_RAW_MASKS = {0xbe: 0xff, 0xc2: 0xff, 0x03: 0xffff, 0x05: 0xffff, 0xc4: 0xffff, 0x09: 0xffffff}
+
+def ata_smart_attributes(block):
+    # id -> raw value, from the 30 entries of the SMART READ DATA block
+    if sum(map(ord, block)) & 0xff:
+        raise ValueError('bad SMART data checksum')
+    attrs = {}
+    for i in range(30):
+        id, flags, value, worst, raw = smart_entry.unpack_from(block, 2 + i * smart_entry.size)
+        if id == 0:
+            continue
+        raw = sum(ord(c) << (8 * j) for j, c in enumerate(raw))
+        attrs[id] = raw & SMART_RAW_MASKS.get(id, 0xffffffffffff)
+    return attrs
+
+def fake_disk(path, name, attrs, serial = 'FAKE0001', model = 'FAKE DISK', firmware = 'FW01', standby = False):
+    # writes what FakeSgIo answers for path/name, attrs is id -> raw value
+    def ata_words(s, length):
+        s = s.ljust(length)
+        return ''.join(s[i + 1] + s[i] for i in range(0, length, 2))
+    identify = bytearray(512)
+    identify[20:40] = ata_words(serial, 20)
+    identify[46:54] = ata_words(firmware, 8)
+    identify[54:94] = ata_words(model, 40)
+    smart = bytearray(512)
+    for i, id in enumerate(sorted(attrs.keys())[:30]):
+        raw = ''.join(chr(attrs[id] >> (8 * j) & 0xff) for j in range(6))
+        smart[2 + i * 12:14 + i * 12] = smart_entry.pack(id, 0, 100, 100, raw)
+    smart[511] = -sum(smart) & 0xff
+    disk = join(path, name)
+    if not isdir(disk):
+        makedirs(disk)
+    for f, content in (('identify', identify), ('smart', smart), ('power', standby and 'standby' or 'active')):
+        f = open(join(disk, f), 'wb')
+        try:
+            f.write(str(content))
+        finally:
+            f.close()
+
 class HDD_Monitor(object):
     def __init__(self, **kwargs):
         self.smartctl = 'smartctl'
+        # disks polled at the same time, and how long a smartctl call may take
+        self.jobs = 16
+        self.timeout = 10
+        # SMART history is only kept with a history_file, trends are over the
+        # last history_window seconds
+        self.history_file = None
+        self.history_size = 1024
+        self.history_window = 86400
+        # with an identity_file, smartctl -i is only needed once per disk, ever
+        self.identity_file = None
+        self.sys_block = SYS_BLOCK_PATH
+        # scheduling, in seconds: active disks are polled every poll_interval, or
+        # every poll_interval_hot when they're at temp_warn or have sector_warn
+        # pending/uncorrectable sectors, disks in standby back off exponentially
+        # up to poll_interval_max
+        self.poll_interval = 300
+        self.poll_interval_hot = 30
+        self.poll_interval_max = 3600
+        self.temp_warn = 45
+        self.sector_warn = 1
+        # serve the last polled values at http://metrics_address:metrics_port/metrics
+        self.metrics_address = ''
+        self.metrics_port = None
+        # serve snapshots to a Fleet aggregator at agent_address:agent_port
+        self.agent_address = ''
+        self.agent_port = None
+        # the dashboard redraws every dashboard_interval seconds, polls or not
+        self.dashboard_interval = .5
+        self.diskstats = DISKSTATS_PATH
+        self.mdstat = MDSTAT_PATH
+        # with sg_io, SMART is read by ioctl, smartctl is only for the disks
+        # that doesn't work on; sg_io_fake is a FakeSgIo directory instead
+        self.sg_io = False
+        self.sg_io_fake = None
+        # errors that can go away, a bad checksum or an EIO, are retried after
+        # sg_io_retry seconds, not supporting the ioctl at all is for good
+        self.sg_io_retry = 3600
         self.__dict__.update(kwargs)
+        self.sg = None
+        if self.sg_io_fake:
+            self.sg = FakeSgIo(self.sg_io_fake)
+        elif self.sg_io:
+            self.sg = SgIo()
+        # hdd -> (when to try SG_IO again, None for never, why it didn't work)
+        self.sg_io_failed = {}
+        self.sg_io_calls = 0
+        self.md = exists(self.mdstat) and MdstatWatcher(self.mdstat) or None
+        self.io = exists(self.diskstats) and DiskStats(self.diskstats) or None
+        self.io_arrays = {}
+        if self.io is not None:
+            self.io.sample()
+        # prometheus text of the last polled values, rebuilt by the poller
+        self.snapshot = ''
+        self.snapshot_time = 0
+        # and what an agent sends, see AgentHandler
+        self.agent_snapshot = ''
+        self.identity_lock = Lock()
+        self.identities = {}
+        if self.identity_file and exists(self.identity_file):
+            # json gives unicode back
+            utf8 = lambda u: u.encode('utf-8')
+            self.identities = dict((utf8(wwid), dict((utf8(k), utf8(v)) for k, v in identity.items()))
+                for wwid, identity in load(open(self.identity_file)).items())
+        self.history = self.history_file and SmartHistory(self.history_file, self.history_size) or None
         self.hdds = {}
         self.count_by_size = {}
         self.get_hdd_list()
-        self.formatting = '%-5s%5s %-6s%-25s%-20s%-10s%5s%5s%8s%5s%8s%5s%5s%5s\n'
+        self.formatting = '%-5s%5s %-6s%-25s%-20s%-10s%5s%5s%8s%5s%8s%5s%5s%5s%6s%6s%5s%5s%7s%7s%6s%7s%5s\n'
         self.standby_formatting = "%-5s%5s %-6s%-25s-STANDBY-\n"
-        self.header = self.formatting % ('', 'Size', 'mdadm', 'Model', 'Serial', 'Version', 'Temp', '0x05', '0x09', '0x0A', '0xC1', '0xC4', '0xC5', '0xC6') \
-            + self.formatting % (("",) + ('===',) * 13)
+        self.timeout_formatting = "%-5s%5s %-6s%-25s-TIMEOUT-\n"
+        self.header = self.formatting % ('', 'Size', 'mdadm', 'Model', 'Serial', 'Version', 'Temp', '0x05', '0x09', '0x0A', '0xC1', '0xC4', '0xC5', '0xC6',
+                'dTemp', 'T/h', 'd05', 'dC5', 'rMB/s', 'wMB/s', 'IOPS', 'await', 'util') \
+            + self.formatting % (("",) + ('===',) * 22)
         #for hdd in self.hdds:
         #    self.update_one(hdd)
-        self.idx = 0
+        self.smartctl_calls = 0
+        # (due time, hdd) heap, everything is due right away
+        self.due = [(0, hdd) for hdd in self.hdds]
+        heapify(self.due)
+        self.backoff = {}
+        self.schedule_cond = Condition()
+        # disks with a smartctl call in flight
+        self.polling = set()
 
     # deprecated for completeness
     def get_hdd_list_smartctl(self):
@@ -44,7 +825,40 @@ class HDD_Monitor(object):
             hdd_list = filter(None, [l.partition(' ')[0] for l in out.split('\n')])
             self.hdds = dict(zip(hdd_list, [{'device': hdd} for hdd in hdd_list]))
 
+    # all from sysfs, no fork
     def get_hdd_list(self):
+        # partition -> the disk it's on
+        parent = {}
+        for name in sorted(listdir(self.sys_block)):
+            path = join(self.sys_block, name)
+            # only real disks have a device, not loop/zram/md/dm, skip optical drives
+            if not exists(join(path, "device")) or read_sys(path, "device", "type") == "5":
+                continue
+            size = format_size(int(read_sys(path, "size") or 0) * 512)
+            hdd = {"device": "/dev/" + name, "size": size}
+            model = read_sys(path, "device", "model")
+            if model:
+                hdd["Device Model"] = model
+            wwid = read_sys(path, "device", "wwid") or read_sys(path, "wwid")
+            if wwid:
+                hdd["wwid"] = wwid
+                hdd.update(self.identities.get(wwid, {}))
+            self.hdds[name] = hdd
+            self.count_by_size[size] = (self.count_by_size.get(size) or 0) + 1
+            for part in listdir(path):
+                if exists(join(path, part, "partition")):
+                    parent[part] = name
+        for md in listdir(self.sys_block):
+            slaves = join(self.sys_block, md, "slaves")
+            if not md.startswith("md") or not isdir(slaves):
+                continue
+            for slave in listdir(slaves):
+                hdd = self.hdds.get(parent.get(slave, slave))
+                if hdd:
+                    hdd["mdadm"] = md
+
+    # deprecated for completeness
+    def get_hdd_list_lsblk(self):
         exit, out, _ = call(["lsblk", "-abdlnr", "-o", "NAME,TYPE,SIZE,MODEL"])
         if exit == 0:
             hdd_list = filter(None, [(l[0], format_size(int(l[2])), l[3]) if len(l) == 4 and l[1] == "disk" else None for l in
@@ -76,8 +890,29 @@ class HDD_Monitor(object):
     def update_one(self, hdd):
         info = self.hdds[hdd]
         serial_ready = 'Serial Number' in info
-        exit, out, err = call([self.smartctl, '-n', 'standby', serial_ready and '-A' or '-iA', info["device"]])
-        if exit == 0:
+        failed = self.sg_io_failed.get(hdd)
+        if self.sg is not None and (failed is None or failed[0] is not None and failed[0] <= time()):
+            try:
+                self.update_one_sg_io(hdd, info)
+            except (IOError, OSError, ValueError), e:
+                # no root, not ATA, a USB bridge only smartctl knows how to talk to...
+                retry = None
+                if getattr(e, 'errno', None) not in SG_IO_UNSUPPORTED:
+                    # ...or just a bad moment
+                    retry = time() + self.sg_io_retry
+                self.sg_io_failed[hdd] = retry, e
+            else:
+                self.sg_io_failed.pop(hdd, None)
+                self.polled(hdd, info, serial_ready)
+                return
+        self.smartctl_calls += 1
+        exit, out, err = call([self.smartctl, '-n', 'standby', serial_ready and '-A' or '-iA', info["device"]],
+            timeout = self.timeout)
+        info['updated'] = time()
+        info['TIMEOUT'] = exit is None
+        if exit is None:
+            return
+        elif exit == 0:
             info['STANDBY'] = False
         elif exit == 2 and out.find('STANDBY') > -1:
             info['STANDBY'] = True
@@ -89,7 +924,6 @@ class HDD_Monitor(object):
         # 1 in info sec and waiting for smart sec
         # 2 in smart sec
         mode = 0
-        ret = {}
         for l in [l.strip() for l in out.split('\n')]:
             if mode == 0:
                 if not serial_ready:
@@ -111,10 +945,59 @@ class HDD_Monitor(object):
                 l = filter(None, [c.strip() for c in l.split(' ')])
                 if len(l) >= 10 and l[0].isdigit() and l[9].isdigit():
                     info["%02x" % int(l[0])] = int(l[9])
+        self.polled(hdd, info, serial_ready)
+
+    def update_one_sg_io(self, hdd, info):
+        # what update_one does with smartctl -n standby -A, by ioctl
+        device = info["device"]
+        self.sg_io_calls += 1
+        _, power = ata_command(self.sg, device, ATA_CHECK_POWER_MODE, timeout = self.timeout)
+        if power is None:
+            raise IOError('no power mode from %s' % device)
+        info['updated'] = time()
+        info['TIMEOUT'] = False
+        # standby, or standby_y
+        info['STANDBY'] = power in (0x00, 0x01)
+        if info['STANDBY']:
+            return
+        if 'Serial Number' not in info:
+            block, _ = ata_command(self.sg, device, ATA_IDENTIFY, data = True, timeout = self.timeout)
+            info.update(ata_identity(block))
+        block, _ = ata_command(self.sg, device, ATA_SMART, ATA_SMART_READ_DATA, 0x4f, 0xc2, True, self.timeout)
+        for id, raw in ata_smart_attributes(block).items():
+            info["%02x" % id] = raw
+
+    def polled(self, hdd, info, serial_ready):
+        # whichever way hdd was polled
+        if not serial_ready and 'wwid' in info and self.identity_file:
+            self.save_identity(info)
+        if self.history is not None and not info['STANDBY']:
+            self.history.append(self.history_key(hdd), time(), info)
+
+    def save_identity(self, info):
+        with self.identity_lock:
+            self.identities[info['wwid']] = dict((k, info[k]) for k in IDENTITY_KEYS if k in info)
+            f = open(self.identity_file + '.tmp', 'w')
+            try:
+                dump(self.identities, f, indent = 1, sort_keys = True)
+            finally:
+                f.close()
+            rename(self.identity_file + '.tmp', self.identity_file)
+
+    def history_key(self, hdd):
+        # device names can change between boots, serials don't
+        return self.hdds[hdd].get('Serial Number') or hdd
 
     def report_one(self, hdd):
         r = self.hdds[hdd]
-        if r.get("STANDBY"):
+        if r.get("TIMEOUT"):
+            return self.timeout_formatting % (
+                hdd,
+                r.get("size"),
+                r.get("mdadm", "-"),
+                r.get("Device Model", "-")
+            )
+        elif r.get("STANDBY"):
             return self.standby_formatting % (
                 hdd,
                 r.get("size"),
@@ -122,7 +1005,10 @@ class HDD_Monitor(object):
                 r.get("Device Model", "-")
             )
         else:
-            return self.formatting % (
+            trend = {}
+            if self.history is not None:
+                trend = self.history.trend(self.history_key(hdd), self.history_window)
+            return self.formatting % ((
                 hdd,
                 r.get("size"),
                 r.get("mdadm", "-"),
@@ -136,74 +1022,342 @@ class HDD_Monitor(object):
                 r.get("c1", "-"), # Load Cycle Count
                 r.get("c4", "-"), # Reallocated Event Count
                 r.get("c5", "-"), # Current Pending Sector
-                r.get("c6", "-")  # Offline Uncorrectable
-            )
+                r.get("c6", "-"), # Offline Uncorrectable
+                # changes over history_window
+                "c2" in trend and "%+d" % trend["c2"][0] or "-",
+                "c2" in trend and trend["c2"][1] is not None and "%+.1f" % trend["c2"][1] or "-",
+                "05" in trend and "%+d" % trend["05"][0] or "-",
+                "c5" in trend and "%+d" % trend["c5"][0] or "-"
+            ) + self.io_columns(hdd))
+
+    def io_columns(self, hdd):
+        # rMB/s, wMB/s, IOPS, await and util, slow array members get a * on await
+        io = self.io and self.io.rates.get(hdd)
+        if io is None:
+            return ("-",) * 5
+        slow = hdd in self.io_arrays.get(self.hdds[hdd].get("mdadm"), {}).get("slow", ())
+        return ("%.1f" % (io["read_bps"] / 1e6), "%.1f" % (io["write_bps"] / 1e6), "%d" % io["iops"],
+            "%.1f%s" % (io["await"], slow and "*" or ""), "%d%%" % io["util"])
 
     def report(self):
+        hdds = sorted(self.hdds.keys(), lambda a, b: cmp(len(a), len(b)) or cmp(a, b))
+        # smartctl calls run on a pool, rows are still yielded in order, each one
+        # as soon as its disk is done
+        pool = ThreadPool(max(1, min(self.jobs, len(hdds))))
+        results = [pool.apply_async(self.update_one, (hdd,)) for hdd in hdds]
+        # don't join, a disk hanging in the kernel can keep its worker forever
+        pool.close()
+        if self.io is not None:
+            # smartctl is busy anyway, this waits until the window is long enough
+            self.io_arrays = array_stats(self.hdds, self.io.sample())
+        for hdd, result in zip(hdds, results):
+            try:
+                # a second more than call() gives smartctl before killing it
+                result.get(self.timeout + 1)
+            except TimeoutError:
+                self.hdds[hdd]["TIMEOUT"] = True
+            yield self.report_one(hdd)
+        for s in self.report_summary():
+            yield s
+
+    def report_summary(self):
+        # the lines under the table, from what was last polled
         standby = 0
-        for hdd in sorted(self.hdds.keys(), lambda a, b: cmp(len(a), len(b)) or cmp(a, b)):
-            self.update_one(hdd)
-            if self.hdds[hdd].get("STANDBY"):
+        timeout = 0
+        for r in self.hdds.values():
+            if r.get("TIMEOUT"):
+                timeout += 1
+            elif r.get("STANDBY"):
                 standby += 1
-            yield self.report_one(hdd)
-        yield  "===\nActive/Total: %d/%d, By Size: %s\n" % \
-            (len(self.hdds) - standby, len(self.hdds),
+        yield  "===\nActive/Total: %d/%d, %sBy Size: %s\n" % \
+            (len(self.hdds) - standby - timeout, len(self.hdds),
+                timeout and "Timeout: %d, " % timeout or "",
                 ", ".join("%s*%d" % d for d in self.count_by_size.items()))
+        if self.md is not None:
+            if not self.md.watching or self.md.syncing():
+                # the kernel doesn't signal progress, only state changes
+                self.md.refresh()
+            # copied under the lock, the watcher thread can refresh while
+            # this generator is paused at a yield
+            with self.md.lock:
+                summaries = [self.md.summary(md) for md in sorted(self.md.arrays.keys())]
+                events = list(self.md.events)
+            for summary in summaries:
+                yield summary + "\n"
+            for t, e in events:
+                yield "%s %s\n" % (datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S"), e)
+        for md in sorted(self.io_arrays.keys()):
+            a = self.io_arrays[md]
+            yield "%s: %.1fMB/s read, %.1fMB/s write, %d IOPS, max await %.1fms, max util %d%%%s\n" % (
+                md, a["read_bps"] / 1e6, a["write_bps"] / 1e6, a["iops"], a["await"], a["util"],
+                a["slow"] and ", slow: " + " ".join(a["slow"]) or "")
 
     def report_by_model(self):
-        models = {}
-        for hdd in self.hdds.values():
-            model_name = hdd.get('Device Model', '-N/A-')
-            model = models.get(model_name)
-            if model is None:
-                models[model_name] = [hdd]
-            else:
-                model.append(hdd)
-        report = []
-        for model_name in models:
-            report.append('%s: %s' % (model_name, self.report_on_list(models[model_name])))
-        report.append('===')
-        report.append('Total: ' + self.report_on_list(self.hdds.values()))
-        return '\n'.join(report)
+        return report_by_model(self.hdds.values())
+
+    def interval(self, hdd):
+        # seconds until hdd is due again
+        info = self.hdds[hdd]
+        if info.get("STANDBY") and not info.get("TIMEOUT"):
+            # every time it's still asleep, leave it alone twice as long
+            i = min(self.backoff.get(hdd, self.poll_interval / 2.) * 2, self.poll_interval_max)
+            self.backoff[hdd] = i
+            return i
+        self.backoff.pop(hdd, None)
+        if info.get("c2", 0) >= self.temp_warn or \
+                info.get("c5", 0) >= self.sector_warn or info.get("c6", 0) >= self.sector_warn:
+            return self.poll_interval_hot
+        if self.history is not None and \
+                self.history.trend(self.history_key(hdd), self.history_window).get("05", (0,))[0] > 0:
+            # reallocated sectors growing
+            return self.poll_interval_hot
+        return self.poll_interval
+
+    def reschedule(self, hdd):
+        with self.schedule_cond:
+            heappush(self.due, (time() + self.interval(hdd), hdd))
+            self.schedule_cond.notify()
+
+    def pop_due(self):
+        # waits for the next disk to be due, then returns every disk that is
+        with self.schedule_cond:
+            while True:
+                now = time()
+                if self.due and self.due[0][0] <= now:
+                    break
+                self.schedule_cond.wait(self.due and self.due[0][0] - now or None)
+            hdds = []
+            while self.due and self.due[0][0] <= now:
+                hdds.append(heappop(self.due)[1])
+            return hdds
 
     def next(self):
-        self.update_one(self.hdds.keys()[self.idx])
-        self.idx = (self.idx + 1) % len(self.hdds)
+        # polls whatever is due next, waiting for it if needed
+        hdds = self.pop_due()
+        for hdd in hdds:
+            self.update_one(hdd)
+            self.reschedule(hdd)
+        return hdds
+
+    def poll_one(self, hdd):
+        self.polling.add(hdd)
+        try:
+            self.update_one(hdd)
+            self.update_snapshot()
+        finally:
+            self.polling.discard(hdd)
+            self.reschedule(hdd)
+
+    def update_snapshot(self):
+        # the cost of a scrape stays the same whatever the number of disks, it's
+        # paid here, once per poll
+        standby, timeout, updated, md, attrs = [], [], [], [], []
+        for hdd in sorted(self.hdds.keys()):
+            r = self.hdds[hdd]
+            labels = (('device', hdd), ('model', r.get('Device Model', '')), ('serial', r.get('Serial Number', '')))
+            standby.append(metric('hddm_standby', labels, int(bool(r.get('STANDBY')))))
+            timeout.append(metric('hddm_timeout', labels, int(bool(r.get('TIMEOUT')))))
+            if 'updated' in r:
+                updated.append(metric('hddm_last_poll_timestamp_seconds', labels, '%.3f' % r['updated']))
+            if 'mdadm' in r:
+                md.append(metric('hddm_md_member', labels + (('array', r['mdadm']),), 1))
+            for k in sorted(r.keys()):
+                if smart_attribute_pattern.match(k):
+                    attrs.append(metric('hddm_smart_attribute_raw', labels + (('id', '0x' + k.upper()),), r[k]))
+        disks = [metric('hddm_disks', (('size', size),), count) for size, count in sorted(self.count_by_size.items())]
+        m = []
+        # the text format wants each metric in one group
+        for name, kind, lines in (
+                ('hddm_standby', 'gauge', standby),
+                ('hddm_timeout', 'gauge', timeout),
+                ('hddm_last_poll_timestamp_seconds', 'gauge', updated),
+                ('hddm_md_member', 'gauge', md),
+                ('hddm_smart_attribute_raw', 'gauge', attrs),
+                ('hddm_disks', 'gauge', disks),
+                ('hddm_smartctl_calls_total', 'counter', ['hddm_smartctl_calls_total %d\n' % self.smartctl_calls]),
+                ('hddm_sg_io_polls_total', 'counter', ['hddm_sg_io_polls_total %d\n' % self.sg_io_calls]),
+                ('hddm_sg_io_failed', 'gauge', ['hddm_sg_io_failed %d\n' % len(self.sg_io_failed)])):
+            m.append('# TYPE %s %s\n' % (name, kind))
+            m.extend(lines)
+        now = time()
+        self.snapshot, self.snapshot_time = ''.join(m), now
+        if self.agent_port:
+            arrays = []
+            if self.md is not None:
+                with self.md.lock:
+                    arrays = [self.md.summary(array) for array in sorted(self.md.arrays.keys())]
+            self.agent_snapshot = compress(dumps({
+                'host': gethostname(),
+                'time': now,
+                'hdds': [dict(self.hdds[hdd], name = hdd) for hdd in sorted(self.hdds.keys())],
+                'md': arrays,
+            }, separators = (',', ':')))
+
+    def metrics(self, started):
+        snapshot, snapshot_time = self.snapshot, self.snapshot_time
+        now = time()
+        return '%s# TYPE hddm_snapshot_age_seconds gauge\nhddm_snapshot_age_seconds %.3f\n' \
+            '# TYPE hddm_scrape_duration_seconds gauge\nhddm_scrape_duration_seconds %.6f\n' % (
+            snapshot, snapshot_time and now - snapshot_time or -1, now - started)
+
+    def serve_metrics(self):
+        # blocks, start() the poller first
+        self.update_snapshot()
+        server = MetricsServer((self.metrics_address, self.metrics_port), MetricsHandler)
+        server.hddm = self
+        server.serve_forever()
+
+    def serve_agent(self):
+        # doesn't block, unlike serve_metrics
+        self.update_snapshot()
+        server = AgentServer((self.agent_address, self.agent_port), AgentHandler)
+        server.hddm = self
+        t = Thread(target = server.serve_forever)
+        t.daemon = True
+        t.start()
+        return t
+
+    def poll_forever(self):
+        # at most jobs smartctl calls at a time
+        pool = ThreadPool(max(1, self.jobs))
+        while True:
+            for hdd in self.pop_due():
+                pool.apply_async(self.poll_one, (hdd,))
+
+    def start(self):
+        # keeps self.hdds up to date in the background
+        if self.md is not None:
+            self.md.start()
+        t = Thread(target = self.poll_forever)
+        t.daemon = True
+        t.start()
+        return t
+
+    def age(self, hdd, now):
+        # how old the row of hdd is, for the dashboard
+        if hdd in self.polling:
+            return "poll"
+        updated = self.hdds[hdd].get("updated")
+        if updated is None:
+            return "-"
+        age = now - updated
+        for unit, seconds in (("h", 3600), ("m", 60)):
+            if age >= seconds * 2:
+                return "%d%s" % (age / seconds, unit)
+        return "%ds" % age
+
+    def dashboard_lines(self):
+        now = time()
+        if self.io is not None and (self.io.last is None or now - self.io.last[0] >= 1):
+            self.io_arrays = array_stats(self.hdds, self.io.sample())
+        hdds = sorted(self.hdds.keys(), lambda a, b: cmp(len(a), len(b)) or cmp(a, b))
+        lines = ["%5s %s" % (a, l) for a, l in zip(("Age", ""), self.header.splitlines())]
+        lines.extend("%5s %s" % (self.age(hdd, now), self.report_one(hdd).rstrip("\n")) for hdd in hdds)
+        for s in self.report_summary():
+            lines.extend(s.splitlines())
+        return lines
+
+    def dashboard(self, screen):
+        # curses.wrapper(hddm.dashboard), start() the poller first; only the
+        # cells that changed since the last frame are written to the terminal
+        import curses
+        curses.curs_set(0)
+        screen.timeout(int(self.dashboard_interval * 1000))
+        shown = []
+        top = 0
+        while True:
+            height, width = screen.getmaxyx()
+            lines = self.dashboard_lines()
+            status = "%s, %d smartctl calls, %d in flight, q to quit, up/down to scroll, ^L to redraw" % (
+                datetime.now().strftime("%Y-%m-%d %H:%M:%S"), self.smartctl_calls, len(self.polling))
+            # the header and status lines stay, the rest scrolls
+            body = height - 3
+            top = max(0, min(top, len(lines) - 2 - body))
+            frame = lines[:2] + lines[2 + top:2 + top + body] + [status]
+            for y in range(min(height, max(len(frame), len(shown)))):
+                new = y < len(frame) and frame[y][:width - 1] or ""
+                old = y < len(shown) and shown[y] or ""
+                if new == old:
+                    continue
+                x = 0
+                while x < len(new) and x < len(old) and new[x] == old[x]:
+                    x += 1
+                screen.move(y, x)
+                screen.addstr(new[x:])
+                screen.clrtoeol()
+            shown = [l[:width - 1] for l in frame[:height]]
+            screen.refresh()
+            key = screen.getch()
+            if key in (ord("q"), ord("Q")):
+                return
+            elif key == curses.KEY_UP:
+                top -= 1
+            elif key == curses.KEY_DOWN:
+                top += 1
+            elif key == curses.KEY_PPAGE:
+                top -= body
+            elif key == curses.KEY_NPAGE:
+                top += body
+            elif key in (curses.KEY_RESIZE, 12):
+                # or ^L, after smartctl errors were printed over it
+                screen.clear()
+                shown = []
 
     def report_on_list(self, hdds):
-        standby = 0
-        temp_sum = 0.
-        temp_count = 0
-        temp_max = 0
-        for d in hdds:
-            if d['STANDBY']:
-                standby += 1
-            else:
-                temp = d.get('Temperature_Celsius')
-                if temp is not None:
-                    temp_sum += temp
-                    temp_count += 1
-                    if temp > temp_max:
-                        temp_max = temp
-        return 'Active/Total: %d/%d, Temp: %s' % (
-            len(hdds) - standby, len(hdds),
-            (temp_count > 0) and ('Avg: %.1f, Max: %.1f' % (temp_sum / temp_count, temp_max)) or '-N/A-')
+        return report_on_list(hdds)
 
+def parse_value(v):
+    # name=value from the command line, numbers are numbers, 0 included
+    for t in (int, float):
+        try:
+            return t(v)
+        except ValueError:
+            pass
+    return v
 
 if __name__ == '__main__':
-    hddm = HDD_Monitor()
-    from time import sleep
-    from datetime import datetime
-    import os
-    print hddm.header,
-    for s in hddm.report():
-	    print s,
-"""
-    while True:
-        os.system(os.name == 'nt' and 'cls' or 'clear')
-        print hddm.report_by_model()
-        print datetime.now()
-        sleep(.5)
-        hddm.next()
-"""
-
+    from sys import argv
+    # HDD_Monitor.py [name=value ...], e.g. jobs=32 history_file=/var/lib/hddm.history
+    # HDD_Monitor.py agent_port=9101, then on another box
+    # HDD_Monitor.py fleet=host1:9101,host2:9101 [fleet_interval=60]
+    kwargs = {}
+    for arg in argv[1:]:
+        k, _, v = arg.partition('=')
+        kwargs[k] = parse_value(v)
+    if 'fleet' in kwargs:
+        fleet = Fleet(kwargs['fleet'].split(','), kwargs.get('timeout', 10))
+        while True:
+            fleet.fetch()
+            print fleet.report()
+            if not kwargs.get('fleet_interval'):
+                break
+            print datetime.now()
+            sleep(kwargs['fleet_interval'])
+        raise SystemExit
+    # not an attribute, that would shadow the method
+    dashboard = kwargs.pop('dashboard', None) is not None
+    hddm = HDD_Monitor(**kwargs)
+    if dashboard:
+        # HDD_Monitor.py dashboard [dashboard_interval=0.5], still serves
+        # metrics/agent in the background if asked to
+        from curses import wrapper
+        hddm.start()
+        if hddm.agent_port:
+            hddm.serve_agent()
+        if hddm.metrics_port:
+            t = Thread(target = hddm.serve_metrics)
+            t.daemon = True
+            t.start()
+        wrapper(hddm.dashboard)
+    elif hddm.metrics_port or hddm.agent_port:
+        hddm.start()
+        if hddm.agent_port:
+            hddm.serve_agent()
+        if hddm.metrics_port:
+            hddm.serve_metrics()
+        while True:
+            sleep(3600)
+    else:
+        print hddm.header,
+        for s in hddm.report():
+            print s,
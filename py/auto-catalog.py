@@ -1,9 +1,25 @@
 #!/usr/bin/python
 # vim: set fileencoding=utf-8
-from os import listdir, mkdir, rename
-from os.path import isdir, isfile, join, exists
+from os import listdir, mkdir, rename, remove, stat, fstat, fsync, lseek, close, SEEK_SET, O_RDONLY
+from os import open as os_open
+from os.path import isdir, isfile, join, exists, dirname
+from shutil import copystat
+from errno import EXDEV, EINTR, ENOSYS, EINVAL, EOPNOTSUPP, EBADF
 from sys import stderr, platform
 from re import compile, UNICODE
+from codecs import lookup_error, register_error
+from json import dumps, loads
+from multiprocessing.pool import ThreadPool
+from threading import Thread, RLock
+from Queue import Queue
+try:
+    from os import scandir
+except ImportError:
+    # python 2 needs the scandir package from PyPI
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 if platform == 'win32':
     from ctypes import windll
@@ -12,11 +28,47 @@ else:
     CODEC = 'utf-8'
 
 prefix_match = lambda s, fix: len(s) > len(fix) and s[:len(fix)] == fix
-safe_lower = lambda s: s.decode(CODEC).lower().encode(CODEC)
 
-def dedup_rules(rules, prompt):
-    # TODO: since the auto_rule_pattern has been changed, we should improve
-    # dedup to handle prefix match too
+def surrogateescape(e):
+    # python 2 doesn't have this one, undecodable bytes become U+DC80..U+DCFF
+    # like they do in python 3, so every name gets a key
+    if not isinstance(e, UnicodeDecodeError):
+        raise e
+    return u''.join(unichr(0xdc00 + ord(c)) for c in e.object[e.start:e.end]), e.end
+try:
+    lookup_error('surrogateescape')
+except LookupError:
+    register_error('surrogateescape', surrogateescape)
+
+# paths stay native str all the way, only rules and lookups use keys: a name
+# decoded and lowered once, everything matched against a key is a key too
+name_key = lambda name: name.decode(CODEC, 'surrogateescape').lower()
+
+escaped_split = compile(u'((?<![\ud800-\udbff])[\udc80-\udcff]+)').split
+def key_str(key):
+    # back to CODEC for printing and plans, python 2's utf-8 codec would encode
+    # the escaped bytes as surrogates instead of calling the error handler
+    parts = escaped_split(key)
+    for i in xrange(1, len(parts), 2):
+        parts[i] = ''.join(chr(ord(c) - 0xdc00) for c in parts[i])
+    for i in xrange(0, len(parts), 2):
+        parts[i] = parts[i].encode(CODEC)
+    return ''.join(parts)
+
+def list_dir(path):
+    # yields (name, is_dir, is_file), scandir gets these from d_type for free,
+    # without it we fall back to a stat per entry
+    if scandir is not None:
+        for e in scandir(path):
+            yield e.name, e.is_dir(), e.is_file()
+    else:
+        for name in listdir(path):
+            full = join(path, name)
+            yield name, isdir(full), isfile(full)
+
+def dedup_rules(rules, prompt, ambiguous = None, exact_only = None):
+    # with exact_only, rules that are a prefix of, or prefixed by, a rule for
+    # another location are added to it
     dupe = {}
     ret = {}
     for k, v in rules:
@@ -30,156 +82,1053 @@ def dedup_rules(rules, prompt):
                 del ret[k]
             else:
                 ret[k] = v
+    if exact_only is not None:
+        # since the auto_rule_pattern has been changed, a rule can be a prefix
+        # of another rule for a different location, like [grp][show] and
+        # [grp][show][s2]; get_prefix still tells them apart, but the longest
+        # prefix fallback can't be trusted with them
+        trie = PrefixTrie(ret.iteritems())
+        overlap = {}
+        for k, v in ret.iteritems():
+            for k2, v2 in trie.related(k):
+                if v2 != v:
+                    overlap.setdefault(k, []).append((k2, v2))
+        if len(overlap) > 0:
+            print 'the following %d auto rule(s) overlap with rules for other locations' \
+                ' thus will only be used for the exact prefix:\n' % len(overlap),
+            for k in overlap:
+                print '\t%s -> %s\n' % (key_str(k), ret[k]),
+                for k2, v2 in overlap[k]:
+                    print '\t\t%s (%s)\n' % (v2, key_str(k2)),
+        exact_only.update(overlap)
     if len(dupe) > 0:
         print >> stderr, prompt % len(dupe),
         for k in dupe:
-            print >> stderr, '\t%s\n' % k,
+            print >> stderr, '\t%s\n' % key_str(k),
             for d in dupe[k]:
                 print >> stderr, '\t\t%s\n' % d,
+    if ambiguous is not None:
+        ambiguous.update(dupe)
     return ret
 
 def dedup_rules_alt(primary, secondary, prompt):
-    dupes = []
-    for k in secondary.keys(): # we will modify secondary, so a copy of keys is needed
-        for kp in primary:
-            if prefix_match(kp, k) or prefix_match(k, kp):
-                dupes.append((k, secondary[k]))
-                del secondary[k]
+    # drop secondary rules that are a prefix of, or prefixed by, a primary rule,
+    # one trie walk per primary rule instead of comparing every pair
+    trie = PrefixTrie(secondary.iteritems())
+    conflicts = set()
+    for kp in primary:
+        for k, _ in trie.related(kp):
+            conflicts.add(k)
+    dupes = [(k, secondary[k]) for k in secondary if k in conflicts]
+    for k, _ in dupes:
+        del secondary[k]
     if len(dupes) > 0:
         print prompt % len(dupes),
         for k, v in dupes:
-            print '\t%s -> %s\n' % (k, v),
+            print '\t%s -> %s\n' % (key_str(k), v),
+
+class PrefixTrie(object):
+    # a plain dict-of-dicts trie, answers "longest key that is a strict prefix
+    # of s" (the same thing prefix_match tests) in O(len(s))
+    def __init__(self, items = ()):
+        self.root = {}
+        for k, v in items:
+            self.add(k, v)
+
+    def add(self, key, value):
+        node = self.root
+        for c in key:
+            node = node.setdefault(c, {})
+        # None can never be a character, so it marks the end of a key
+        node[None] = (key, value)
+
+    def get(self, key):
+        node = self.root
+        for c in key:
+            node = node.get(c)
+            if node is None:
+                return None
+        found = node.get(None)
+        return found and found[1]
+
+    def remove(self, key):
+        path = []
+        node = self.root
+        for c in key:
+            path.append((node, c))
+            node = node.get(c)
+            if node is None:
+                return
+        node.pop(None, None)
+        # prune the branch we just emptied
+        while path and not node:
+            node, c = path.pop()
+            del node[c]
+
+    def longest(self, s):
+        found = self.longest_item(s)
+        return found and found[1]
+
+    def longest_item(self, s, skip = ()):
+        # (key, value) or None, keys in skip are passed over
+        node = self.root
+        found = None
+        # node is s[:i] here, so a key only matches names strictly longer
+        # than itself, just like prefix_match
+        for i in xrange(len(s)):
+            if None in node and node[None][0] not in skip:
+                found = node[None]
+            node = node.get(s[i])
+            if node is None:
+                break
+        return found
+
+    def related(self, key):
+        # yields (k, v) for every k that prefix_match(key, k) or prefix_match(k, key)
+        node = self.root
+        for c in key:
+            if None in node:
+                yield node[None]
+            node = node.get(c)
+            if node is None:
+                return
+        stack = [n for c, n in node.iteritems() if c is not None]
+        while stack:
+            node = stack.pop()
+            for c, n in node.iteritems():
+                if c is None:
+                    yield n
+                else:
+                    stack.append(n)
+
+class RuleIndex(object):
+    # manual rules above all, then auto rules by hashing prefix, then the
+    # longest auto rule that is a prefix
+    def __init__(self, manual_rules, auto_rules, ambiguous_manual = (), ambiguous_auto = (), exact_only = ()):
+        self.manual = PrefixTrie(manual_rules.iteritems())
+        self.auto_exact = auto_rules
+        self.auto = PrefixTrie(auto_rules.iteritems())
+        # rules found in several different locations stay ignored for good
+        self.ambiguous_manual = set(ambiguous_manual)
+        self.ambiguous_auto = set(ambiguous_auto)
+        # auto rules overlapping with rules for other locations, they only
+        # match by hashing prefix
+        self.exact_only = set(exact_only)
+
+    def lookup(self, key):
+        return self.match(key)[0]
+
+    def match(self, key):
+        # key is a name_key, returns (target, kind, rule), kind is 'manual',
+        # 'auto' or 'auto_prefix'
+        found = self.manual.longest_item(key)
+        if found is not None:
+            return found[1], 'manual', found[0]
+        prefix = get_prefix(key)
+        if prefix is not None:
+            target = self.auto_exact.get(prefix)
+            if target is not None:
+                return target, 'auto', prefix
+        # some files might not match by hashing prefix, for example:
+        # get_prefix('[foo][bar][01][720p].mp4') = '[foo][bar'
+        # this auto-rule will work for [foo][bar][01][1080p].mp4 / [foo][bar][02][720p].mp4
+        # but get_prefix('[foo][bar][NCOP][720p].mp4') = '[foo][bar][NCOP' won't work
+        found = self.auto.longest_item(key, self.exact_only)
+        if found is not None:
+            return found[1], 'auto_prefix', found[0]
+        return None, None, None
+
+    # incremental updates, these follow what dedup_rules and dedup_rules_alt
+    # would have done if the rule had been there from the beginning
+
+    def remove_auto(self, prefix):
+        del self.auto_exact[prefix]
+        self.auto.remove(prefix)
+        self.exact_only.discard(prefix)
+
+    def add_manual(self, rule, target):
+        if rule in self.ambiguous_manual:
+            return
+        existing = self.manual.get(rule)
+        if existing == target:
+            return
+        if existing is not None:
+            print >> stderr, '!!! CAUTION !!! manual rule %s is considered ambiguous' \
+                ' for appearing in several different locations thus will be ignored:\n' \
+                '\t\t%s\n\t\t%s\n' % (key_str(rule), existing, target),
+            self.manual.remove(rule)
+            self.ambiguous_manual.add(rule)
+            return
+        print '\tmanual prefix rule: %s -> %s\n' % (key_str(rule), target),
+        self.manual.add(rule, target)
+        for k, v in list(self.auto.related(rule)):
+            print '\tauto rule deprecated for a manual rule: %s -> %s\n' % (key_str(k), v),
+            self.remove_auto(k)
+
+    def add_auto(self, prefix, target):
+        if prefix in self.ambiguous_auto:
+            return
+        existing = self.auto_exact.get(prefix)
+        if existing == target:
+            return
+        if existing is not None:
+            print >> stderr, '!!! CAUTION !!! auto rule %s is considered ambiguous' \
+                ' for appearing in several different locations thus will be ignored:\n' \
+                '\t\t%s\n\t\t%s\n' % (key_str(prefix), existing, target),
+            self.remove_auto(prefix)
+            self.ambiguous_auto.add(prefix)
+            return
+        for _ in self.manual.related(prefix):
+            # deprecated for a manual rule
+            return
+        print '\tauto prefix rule: %s -> %s\n' % (key_str(prefix), target),
+        overlap = [(k, v) for k, v in self.auto.related(prefix) if v != target]
+        if overlap:
+            print '\tauto rule %s overlaps with rules for other locations' \
+                ' thus will only be used for the exact prefix, as will they:\n' % key_str(prefix),
+            for k, v in overlap:
+                print '\t\t%s (%s)\n' % (v, key_str(k)),
+                self.exact_only.add(k)
+            self.exact_only.add(prefix)
+        self.auto_exact[prefix] = target
+        self.auto.add(prefix, target)
 
 # auto_rule_pattern = compile(r'^\[[^\]]+\]\[[^\]]+\]')
 # auto_rule_pattern = compile(ur'^([\[\]\(\)\-【】]+(?!(\s|第)?[0-9]{2,3}[^0-9])[^\[\]\(\)\-【】]+){2,}', UNICODE)
+# delimiters and the rest don't overlap, so backtracking never leaves the run
+# it started in and matching stays linear in the name
 auto_rule_pattern = compile(ur'^([\[\]\(\)\-【】]+[^\[\]\(\)\-【】]+){2}'
     ur'([\[\]\(\)\-【】]+(?!(\s|第)?[0-9]{2,3}[^0-9])[^\[\]\(\)\-【】]+)*[\]\)\-】]*', UNICODE)
-def get_prefix(e):
-    e = e.decode(CODEC)
-    match = auto_rule_pattern.match(e)
-    if match is None:
-        return None
-    match = match.group(0)
-    if match == e:
+def get_prefix(key):
+    # key is a name_key, the pattern doesn't care about case so the prefix of
+    # a lowered name is the lowered prefix
+    match = auto_rule_pattern.match(key)
+    if match is None or match.end() == len(key):
         return None
-    return match.lower().encode(CODEC)
+    return match.group(0)
+
+def bench_prefix(count = 200000, seed = 0):
+    # get_prefix against a tokenizer that splits on delimiter runs, on random
+    # bracket-heavy names, release-like ones and very long ones, every result
+    # has to agree; returns False on the first one that doesn't
+    from random import Random
+    from time import time
+    split_delims = compile(ur'([\[\]\(\)\-【】]+)').split
+    def episode_like(text, last):
+        # the lookahead: an optional space or 第, 2 or 3 digits, then anything
+        # but a digit, which may be the next delimiter
+        i = 0
+        if text[0].isspace() or text[0] == u'第':
+            i = 1
+        head = text[i:i + 4]
+        digits = len(head) - len(head.lstrip(u'0123456789'))
+        return 2 <= digits <= 3 and (not last or i + digits < len(text))
+    def split_prefix(key):
+        # text, delims, text, delims, ... text; only the first and the last
+        # text can be empty
+        parts = split_delims(key)
+        if len(parts) < 5 or parts[0] or not parts[4]:
+            return None
+        i = 5
+        while i + 1 < len(parts) and parts[i + 1] and not episode_like(parts[i + 1], i + 2 == len(parts)):
+            i += 2
+        prefix = u''.join(parts[:i])
+        if i < len(parts):
+            prefix += parts[i][:len(parts[i]) - len(parts[i].lstrip(u'])-】'))]
+        if len(prefix) == len(key):
+            return None
+        return prefix
+    r = Random(seed)
+    alphabet = u'[]()-【】[]] \u3000第0123456789abcxyz.'
+    fuzz = [u''.join(r.choice(alphabet) for j in xrange(r.randint(0, 30))) for i in xrange(count)]
+    groups = [u'[grp%d]' % i for i in xrange(20)] + [u'【字幕组%d】' % i for i in xrange(20)]
+    releases = [u''.join((r.choice(groups),
+        r.choice((u'[title %d]' % r.randrange(500), u' title %d - ' % r.randrange(500))),
+        r.choice((u'[%02d]' % r.randrange(30), u'第%d话' % r.randrange(30), u'[ncop]', u' %03d ' % r.randrange(300))),
+        u''.join(r.choice((u'[1080p]', u'[720p]', u'(hevc-10bit)', u'[aac]', u'[chs]'))
+            for j in xrange(r.randint(0, 6))),
+        r.choice((u'.mp4', u'.mkv', u'.ass'))))
+        for i in xrange(count)]
+    # a few thousand characters each, time per character should stay flat
+    long = [u''.join(r.choice((u'[grp', u'][', u'title', u'(hevc)', u'-', u'【1080p】'))
+        for j in xrange(1000)) for i in xrange(count / 1000)]
+    for label, names in (('fuzz', fuzz), ('release', releases), ('long', long)):
+        chars = sum(map(len, names))
+        results = []
+        for f_label, f in (('tokenizer', split_prefix), ('get_prefix', get_prefix)):
+            t = time()
+            results.append(map(f, names))
+            t = time() - t
+            print '%s, %s: %.3fs, %d names/s, %.1fns/char\n' % (
+                label, f_label, t, len(names) / t, t * 1e9 / chars),
+        for name, a, b in zip(names, *results):
+            if a != b:
+                print 'results differ for %r: %r %r\n' % (name, a, b),
+                return False
+    return True
+
+# the rule cache maps bangumi -> ((st_ino, st_mtime), manual rules, auto rules),
+# a dir's mtime changes whenever an entry is added, removed or renamed in it,
+# so an unchanged stamp means the same rules would be generated again
+CACHE_NAME = '.auto-catalog.cache'
+# bump this whenever get_prefix, name_key or manual_rule_re changes
+CACHE_VERSION = 3
+# mtimes on SMB, FAT and some NFS mounts are only good to a second or two, a
+# dir changed that close to a scan may not change its stamp again, so it's
+# rescanned next time rather than cached
+CACHE_MTIME_SLACK = 2
+
+# the cache lives in dst_dir, which may be shared, so it's json like plans
+# are, never anything that can run code when it's loaded
+def load_cache(cache_file):
+    from json import load
+    try:
+        f = open(cache_file, 'rb')
+        try:
+            d = load(f)
+        finally:
+            f.close()
+        if d.get('version') != CACHE_VERSION:
+            return {}
+        # names back to CODEC, auto rules are keys already
+        return dict((key_str(bangumi), ((int(ino), float(mtime)), map(key_str, manual), map(unicode, auto)))
+            for bangumi, ((ino, mtime), manual, auto) in d['bangumis'].iteritems())
+    except Exception:
+        return {}
+
+def save_cache(cache_file, cache):
+    from json import dump
+    dec = lambda s: s.decode(CODEC, 'surrogateescape')
+    tmp_file = cache_file + '.tmp'
+    f = open(tmp_file, 'wb')
+    try:
+        dump({
+            'version': CACHE_VERSION,
+            'bangumis': dict((dec(bangumi), (stamp, map(dec, manual), auto))
+                for bangumi, (stamp, manual, auto) in cache.iteritems()),
+        }, f, separators = (',', ':'))
+    finally:
+        f.close()
+    try:
+        rename(tmp_file, cache_file)
+    except OSError:
+        # windows won't rename over an existing file
+        remove(cache_file)
+        rename(tmp_file, cache_file)
 
-def auto_catalog(src_dir, dst_dir, overwrite_existing = False, dry_run = True):
-    manual_rule_re = compile(r'^prefix=(.+)$')
+manual_rule_re = compile(r'^prefix=(.+)$')
+
+def scan_bangumi(bangumi_full):
+    manual = []
+    auto_rules_dedup = set()
+    for e, e_is_dir, _ in list_dir(bangumi_full): # e for entry
+        if e_is_dir:
+            # find manual rules from dirs with a specified pattern
+            match = manual_rule_re.match(e)
+            if match is None:
+                continue
+            manual.append(match.group(1))
+        elif not e.endswith(PART_SUFFIX):
+            # generate auto rules from existing files
+            prefix = get_prefix(name_key(e))
+            if prefix is None:
+                continue
+            auto_rules_dedup.add(prefix)
+    return manual, list(auto_rules_dedup)
+
+def scan_dst_dir(dst_dir, cache, jobs = 1):
+    # returns [(bangumi, reused, cache entry)] in listing order, bangumi dirs are
+    # independent so they're scanned on a thread pool, listdir/stat release the
+    # GIL and that's where the time goes on network mounts; the stamp is None
+    # for dirs changed too recently to be cached
+    from time import time
+    started = time()
+    def scan_one(bangumi):
+        bangumi_full = join(dst_dir, bangumi)
+        try:
+            st = stat(bangumi_full)
+        except OSError:
+            return None
+        stamp = (st.st_ino, st.st_mtime)
+        entry = cache.get(bangumi)
+        if entry is not None and entry[0] == stamp:
+            return bangumi, True, entry
+        if started - st.st_mtime < CACHE_MTIME_SLACK:
+            stamp = None
+        return bangumi, False, (stamp,) + scan_bangumi(bangumi_full)
+    # we only need dirs
+    bangumis = [name for name, is_dir, _ in list_dir(dst_dir) if is_dir]
+    if jobs > 1 and len(bangumis) > 1:
+        pool = ThreadPool(min(jobs, len(bangumis)))
+        try:
+            # map keeps the input order, so the output is the same as a serial scan
+            results = pool.map(scan_one, bangumis)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(scan_one, bangumis)
+    return filter(None, results)
+
+def generate_rules(dst_dir, cache_file = None, rebuild_cache = False, jobs = 8, dry_run = False):
+    # returns a RuleIndex, or None if there are no rules at all; a dry run
+    # reads the cache but leaves it as it is
     # scan dst_dir for rules
     print 'generating rules:\n',
     # rules are simply prefix -> path mappings
     auto_rules = []
     manual_rules = []
-    for bangumi in listdir(dst_dir):
+    cache = {}
+    if cache_file is not None and not rebuild_cache:
+        cache = load_cache(cache_file)
+    new_cache = {}
+    reused = rescanned = 0
+    for bangumi, cached, entry in scan_dst_dir(dst_dir, cache, jobs):
         bangumi_full = join(dst_dir, bangumi)
-        # listdir list files and sub-dirs, we only need dirs
-        if not isdir(bangumi_full):
-            continue
-        auto_rules_dedup = set()
-        for e in listdir(bangumi_full): # e for entry
-            if isdir(join(bangumi_full, e)):
-                # find manual rules from dirs with a specified pattern
-                match = manual_rule_re.match(e)
-                if match is None:
-                    continue
-                rule = match.group(1)
-                print '\tmanual prefix rule: %s -> %s\n' % (rule, bangumi),
-                manual_rules.append((safe_lower(rule), bangumi_full))
-            else:
-                # generate auto rules from existing files
-                prefix = get_prefix(e)
-                if prefix is None:
-                    continue
-                auto_rules_dedup.add(prefix)
-        for rule in auto_rules_dedup:
-            print '\tauto prefix rule: %s -> %s\n' % (rule, bangumi),
+        if cached:
+            reused += 1
+        else:
+            rescanned += 1
+        if entry[0] is not None:
+            new_cache[bangumi] = entry
+        for rule in entry[1]:
+            print '\tmanual prefix rule: %s -> %s\n' % (rule, bangumi),
+            manual_rules.append((name_key(rule), bangumi_full))
+        for rule in entry[2]:
+            print '\tauto prefix rule: %s -> %s\n' % (key_str(rule), bangumi),
             auto_rules.append((rule, bangumi_full))
+    if cache_file is not None:
+        if not dry_run:
+            save_cache(cache_file, new_cache)
+        print '%d bangumi dir(s) reused from cache, %d rescanned\n' % (
+            reused, rescanned),
 
     # dedup rules
+    ambiguous_manual = set()
+    ambiguous_auto = set()
+    exact_only = set()
     manual_rules = dedup_rules(manual_rules,
         '!!! CAUTION !!! the following %d manual rule(s) are considered ambiguous' \
-        ' for appearing in several different locations thus will be ignored:\n')
+        ' for appearing in several different locations thus will be ignored:\n',
+        ambiguous_manual)
     auto_rules = dedup_rules(auto_rules,
         '!!! CAUTION !!! the following %d auto rule(s) are considered ambiguous' \
-        ' for appearing in several different locations thus will be ignored:\n')
+        ' for appearing in several different locations thus will be ignored:\n',
+        ambiguous_auto, exact_only)
     dedup_rules_alt(manual_rules, auto_rules,
         'the following %d auto rule(s) are deprecated' \
         ' for a manual rule thus will be ignored:\n')
 
     if len(manual_rules) + len(auto_rules) == 0:
         print 'no rules, abort\n',
-        return
+        return None
 
     print '%d auto rule(s), and %d manual rule(s), start moving:\n' \
         % (len(auto_rules), len(manual_rules)),
 
-    manual_rules = zip(manual_rules.keys(), manual_rules.values())
-    manual_rules.sort(lambda a, b: cmp(len(b[0]), len(a[0])))
-    auto_rules_list = zip(auto_rules.keys(), auto_rules.values())
-    auto_rules_list.sort(lambda a, b: cmp(len(b[0]), len(a[0])))
+    return RuleIndex(manual_rules, auto_rules, ambiguous_manual, ambiguous_auto, exact_only)
+
+JOURNAL_NAME = '.auto-catalog.journal'
+PART_SUFFIX = '.auto-catalog.part'
+# a copy is fsync-ed and recorded in the journal this often, an interrupted
+# copy resumes from the last checkpoint
+CHECKPOINT_SIZE = 256 << 20
+COPY_CHUNK = 8 << 20
+
+def kernel_copy_methods():
+    # [(name, f(fd_in, fd_out, count) -> copied)], all of them copy from the
+    # current file position of fd_in to the current file position of fd_out
+    from os import read, write
+    def read_write(fd_in, fd_out, count):
+        data = read(fd_in, min(count, 1 << 20))
+        i = 0
+        while i < len(data):
+            i += write(fd_out, data[i:])
+        return len(data)
+    if not platform.startswith('linux'):
+        return [('read_write', read_write)]
+    from ctypes import CDLL, c_int, c_uint, c_size_t, c_ssize_t, c_void_p, get_errno
+    from ctypes.util import find_library
+    from os import strerror
+    libc = CDLL(find_library('c'), use_errno = True)
+    methods = []
+    def wrap(f, make_args):
+        def call(fd_in, fd_out, count):
+            while True:
+                r = f(*make_args(fd_in, fd_out, count))
+                if r >= 0:
+                    return r
+                e = get_errno()
+                if e != EINTR:
+                    raise OSError(e, strerror(e))
+        return call
+    # copy_file_range needs glibc 2.27, only works across filesystems since linux 5.3
+    if hasattr(libc, 'copy_file_range'):
+        f = libc.copy_file_range
+        f.argtypes = (c_int, c_void_p, c_int, c_void_p, c_size_t, c_uint)
+        f.restype = c_ssize_t
+        methods.append(('copy_file_range',
+            wrap(f, lambda fd_in, fd_out, count: (fd_in, None, fd_out, None, count, 0))))
+    f = libc.sendfile
+    f.argtypes = (c_int, c_int, c_void_p, c_size_t)
+    f.restype = c_ssize_t
+    methods.append(('sendfile', wrap(f, lambda fd_in, fd_out, count: (fd_out, fd_in, None, count))))
+    methods.append(('read_write', read_write))
+    return methods
+
+def copy_data(methods, fd_in, fd_out, offset, size, checkpoint):
+    # copy fd_in[offset:size] to the same offset in fd_out, calls checkpoint(offset)
+    # after every CHECKPOINT_SIZE bytes that hit the disk, returns the final offset
+    lseek(fd_in, offset, SEEK_SET)
+    lseek(fd_out, offset, SEEK_SET)
+    next_checkpoint = offset + CHECKPOINT_SIZE
+    while offset < size:
+        count = min(COPY_CHUNK, size - offset, next_checkpoint - offset)
+        try:
+            copied = methods[0][1](fd_in, fd_out, count)
+        except OSError, e:
+            # not supported for this pair of files, try the next method
+            if len(methods) > 1 and e.errno in (ENOSYS, EXDEV, EINVAL, EOPNOTSUPP, EBADF):
+                methods = methods[1:]
+                continue
+            raise
+        if copied == 0:
+            # src got shorter underneath us
+            break
+        offset += copied
+        if offset >= next_checkpoint:
+            fsync(fd_out)
+            checkpoint(offset)
+            next_checkpoint += CHECKPOINT_SIZE
+    return offset
+
+def fsync_dir(path):
+    # makes a rename in path durable, windows doesn't need or allow it
+    if platform == 'win32':
+        return
+    fd = os_open(path, O_RDONLY)
+    try:
+        fsync(fd)
+    finally:
+        close(fd)
+
+class MoveEngine(object):
+    # rename() when src and dst are on the same filesystem, otherwise the file is
+    # copied by the kernel on a per destination device worker pool, fsync-ed,
+    # then src is removed; every step goes to a write-ahead journal first, so a
+    # run that gets interrupted can be resumed instead of leaving half-copied files
+    def __init__(self, journal_file = None, jobs_per_device = 2):
+        self.journal_file = journal_file
+        self.journal = None
+        self.jobs_per_device = jobs_per_device
+        self.methods = kernel_copy_methods()
+        self.lock = RLock()
+        # st_dev -> (Queue of (src, dst, offset), [worker threads])
+        self.queues = {}
+        self.in_flight = set()
+        self.errors = []
 
+    def log(self, *record):
+        if self.journal_file is None:
+            return
+        with self.lock:
+            if self.journal is None:
+                self.journal = open(self.journal_file, 'ab')
+            # one json line per record, like the rule cache, nothing in
+            # dst_dir gets unpickled
+            self.journal.write(dumps([isinstance(r, str) and r.decode(CODEC, 'surrogateescape') or r
+                for r in record], separators = (',', ':')) + '\n')
+            self.journal.flush()
+            fsync(self.journal.fileno())
+
+    def reset_journal(self):
+        # nothing in flight, so nothing to resume
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+                remove(self.journal_file)
+
+    def move(self, src, dst):
+        with self.lock:
+            if src in self.in_flight:
+                return
+        try:
+            rename(src, dst)
+            return
+        except OSError, e:
+            if e.errno != EXDEV:
+                raise
+        self.queue_copy(src, dst)
+
+    def queue_copy(self, src, dst, offset = 0):
+        dev = stat(dirname(dst)).st_dev
+        with self.lock:
+            self.in_flight.add(src)
+            self.log('begin', src, dst)
+            if offset:
+                self.log('checkpoint', src, dst, offset)
+            if dev not in self.queues:
+                q = Queue()
+                workers = [Thread(target = self.worker, args = (q,)) for i in xrange(self.jobs_per_device)]
+                for t in workers:
+                    t.daemon = True
+                    t.start()
+                self.queues[dev] = q, workers
+            q = self.queues[dev][0]
+        q.put((src, dst, offset))
+
+    def worker(self, q):
+        while True:
+            item = q.get()
+            if item is None:
+                # finish() is waiting for us
+                return
+            src, dst, offset = item
+            try:
+                self.copy(src, dst, offset)
+            except (IOError, OSError), e:
+                print >> stderr, 'failed to move %s -> %s: %s\n' % (src, dst, e),
+                with self.lock:
+                    self.errors.append((src, dst, e))
+                # src is untouched, a copy half done isn't worth keeping
+                try:
+                    remove(dst + PART_SUFFIX)
+                except OSError:
+                    pass
+            finally:
+                with self.lock:
+                    self.in_flight.discard(src)
+                    if not self.in_flight:
+                        self.reset_journal()
+
+    def copy(self, src, dst, offset = 0):
+        part = dst + PART_SUFFIX
+        fin = open(src, 'rb')
+        try:
+            fout = open(part, exists(part) and 'r+b' or 'wb')
+            try:
+                # whatever is past the last checkpoint might not be on the disk
+                fout.truncate(offset)
+                size = fstat(fin.fileno()).st_size
+                copy_data(self.methods, fin.fileno(), fout.fileno(), offset, size,
+                    lambda offset: self.log('checkpoint', src, dst, offset))
+                fsync(fout.fileno())
+            finally:
+                fout.close()
+        finally:
+            fin.close()
+        copystat(src, part)
+        if platform == 'win32' and exists(dst):
+            remove(dst)
+        rename(part, dst)
+        fsync_dir(dirname(dst))
+        self.log('copied', src, dst)
+        remove(src)
+        self.log('done', src, dst)
+
+    def resume(self):
+        # finish what an interrupted run left in the journal, returns how many
+        if self.journal_file is None or not exists(self.journal_file):
+            return 0
+        # (src, dst) -> (last step, offset), in journal order
+        steps = {}
+        order = []
+        f = open(self.journal_file, 'rb')
+        try:
+            for line in f:
+                try:
+                    record = loads(line)
+                    record[1:3] = map(key_str, record[1:3])
+                except Exception:
+                    # the record we were writing when interrupted
+                    break
+                key = tuple(record[1:3])
+                if key not in steps:
+                    order.append(key)
+                    steps[key] = (record[0], 0)
+                elif record[0] == 'checkpoint':
+                    steps[key] = (record[0], record[3])
+                else:
+                    steps[key] = (record[0], steps[key][1])
+        finally:
+            f.close()
+        # pending steps are journaled again from here
+        remove(self.journal_file)
+        resumed = 0
+        for src, dst in order:
+            step, offset = steps[src, dst]
+            if step == 'done':
+                continue
+            resumed += 1
+            if step == 'copied':
+                # dst is complete, only src is left to remove
+                print '\tresumed %s -> %s\n' % (src, dst),
+                if exists(src):
+                    remove(src)
+                continue
+            if not exists(src):
+                continue
+            if not exists(dst + PART_SUFFIX):
+                offset = 0
+            print '\tresuming %s -> %s from %d\n' % (src, dst, offset),
+            self.queue_copy(src, dst, offset)
+        return resumed
+
+    def finish(self):
+        # wait for every queued copy and let the workers go, a copy queued
+        # later starts new ones; returns [(src, dst, error)]
+        with self.lock:
+            queues = self.queues.values()
+            self.queues = {}
+        for q, workers in queues:
+            # each worker takes one None after whatever was queued before it
+            for t in workers:
+                q.put(None)
+            for t in workers:
+                t.join()
+        return self.errors
+
+def catalog_file(index, engine, src_dir, filename, overwrite_existing = False, dry_run = True):
+    # returns (target, moved), target is None for homeless files, cross device
+    # moves are only queued on engine when this returns
+    target = index.lookup(name_key(filename))
+    if target is None:
+        return None, False
+    print '\t%s -> %s\n' % (filename, target),
+    if dry_run:
+        return target, False
+    target_file = join(target, filename)
+    if not exists(target_file) or overwrite_existing:
+        engine.move(join(src_dir, filename), target_file)
+        return target, True
+    return target, False
+
+PLAN_VERSION = 1
+
+class Plan(object):
+    # what auto_catalog is going to do, computed in one pass over src_dir
+    # moves: [(filename, target, kind, rule)], kind/rule as RuleIndex.match,
+    # rule is a key
+    # existed: [(filename, target)], won't overwrite these
+    # homeless: [filename]
+    def __init__(self, src_dir, dst_dir, overwrite_existing = False):
+        self.src_dir = src_dir
+        self.dst_dir = dst_dir
+        self.overwrite_existing = overwrite_existing
+        self.moves = []
+        self.existed = []
+        self.homeless = []
+
+    def save(self, plan_file):
+        # json wants unicode, names are in CODEC and may not even be that
+        from json import dump
+        dec = lambda s: isinstance(s, str) and s.decode(CODEC, 'surrogateescape') or s
+        f = open(plan_file, 'wb')
+        try:
+            dump({
+                'version': PLAN_VERSION,
+                'src_dir': dec(self.src_dir),
+                'dst_dir': dec(self.dst_dir),
+                'overwrite_existing': self.overwrite_existing,
+                'moves': [map(dec, m) for m in self.moves],
+                'existed': [map(dec, e) for e in self.existed],
+                'homeless': map(dec, self.homeless),
+            }, f, separators = (',', ':'))
+        finally:
+            f.close()
+
+    @staticmethod
+    def load(plan_file):
+        from json import load
+        f = open(plan_file, 'rb')
+        try:
+            d = load(f)
+        finally:
+            f.close()
+        if d.get('version') != PLAN_VERSION:
+            raise ValueError('unsupported plan version: %r' % d.get('version'))
+        enc = lambda u: u is not None and key_str(u) or None
+        plan = Plan(enc(d['src_dir']), enc(d['dst_dir']), d['overwrite_existing'])
+        plan.moves = [tuple(map(enc, m)) for m in d['moves']]
+        plan.existed = [tuple(map(enc, e)) for e in d['existed']]
+        plan.homeless = map(enc, d['homeless'])
+        return plan
+
+def make_plan(index, src_dir, dst_dir, overwrite_existing = False):
+    plan = Plan(src_dir, dst_dir, overwrite_existing)
     # scan src_dir
-    homeless = []
-    existed = []
-    for filename in listdir(src_dir):
-        fullname = join(src_dir, filename)
-        lowered = safe_lower(filename)
-        if not isfile(fullname):
+    for filename, _, is_file in list_dir(src_dir):
+        if not is_file:
             continue
-        target = None
-        # manual rules above all
-        for prefix, bangumi_full in manual_rules:
-            if prefix_match(lowered, prefix):
-                target = bangumi_full
-                break
-        # then auto rules by hashing prefix
+        target, kind, rule = index.match(name_key(filename))
         if target is None:
-            prefix = get_prefix(lowered)
-            if prefix is not None:
-                target = auto_rules.get(prefix)
-        # some files might not match by hashing prefix, for example:
-        # get_prefix('[foo][bar][01][720p].mp4') = '[foo][bar'
-        # this auto-rule will work for [foo][bar][01][1080p].mp4 / [foo][bar][02][720p].mp4
-        # but get_prefix('[foo][bar][NCOP][720p].mp4') = '[foo][bar][NCOP' won't work
-        if target is None:
-            for prefix, bangumi_full in auto_rules_list:
-                if prefix_match(lowered, prefix):
-                    target = bangumi_full
-                    break
-        # move the file
-        if target is not None:
-            print '\t%s -> %s\n' % (filename, target),
-            if not dry_run:
-                target_file = join(target, filename)
-                if not exists(target_file) or overwrite_existing:
-                    rename(fullname, target_file)
-                else:
-                    existed.append(filename)
+            plan.homeless.append(filename)
+        elif not overwrite_existing and exists(join(target, filename)):
+            plan.existed.append((filename, target))
         else:
-            homeless.append(filename)
+            plan.moves.append((filename, target, kind, rule))
+    return plan
+
+def apply_plan(plan, engine):
+    # no scanning, just moves, returns [(filename, target)] found existed since
+    # the plan was made, and [(src, dst, error)] that failed
+    existed = []
+    failed = []
+    for filename, target, kind, rule in plan.moves:
+        src = join(plan.src_dir, filename)
+        target_file = join(target, filename)
+        if not plan.overwrite_existing and exists(target_file):
+            existed.append((filename, target))
+            continue
+        try:
+            engine.move(src, target_file)
+        except (IOError, OSError), e:
+            failed.append((src, target_file, e))
+    return existed, failed + engine.finish()
 
+def print_plan(plan, existed = (), failed = ()):
+    existed = plan.existed + list(existed)
     if len(existed):
         print 'the following %d file(s) are not moved, we won\'t overwrite files\n' % len(existed),
-        for e in existed:
+        for e, _ in existed:
             print '\t%s\n' % e,
-    if len(homeless):
-        print 'no matching rule for the following %d file(s):\n' % len(homeless),
-        for e in homeless:
+    if len(plan.homeless):
+        print 'no matching rule for the following %d file(s):\n' % len(plan.homeless),
+        for e in plan.homeless:
             print '\t%s\n' % e,
+    if len(failed):
+        print 'the following %d file(s) failed to move:\n' % len(failed),
+        for src, dst, e in failed:
+            print '\t%s: %s\n' % (src, e),
+
+def auto_catalog(src_dir, dst_dir, overwrite_existing = False, dry_run = True,
+        cache_file = None, rebuild_cache = False, jobs = 8, journal_file = None, copy_jobs = 2,
+        plan_file = None):
+    # with plan_file the plan is saved there instead of being carried out,
+    # returns the plan, None if there are no rules
+    engine = None
+    if not dry_run and plan_file is None:
+        engine = MoveEngine(journal_file, copy_jobs)
+        if engine.resume():
+            engine.finish()
+    index = generate_rules(dst_dir, cache_file, rebuild_cache, jobs, dry_run)
+    if index is None:
+        return None
+
+    plan = make_plan(index, src_dir, dst_dir, overwrite_existing)
+    for filename, target, kind, rule in plan.moves:
+        print '\t%s -> %s\n' % (filename, target),
+    existed = failed = ()
+    if plan_file is not None:
+        plan.save(plan_file)
+        print 'plan with %d move(s) saved to %s\n' % (len(plan.moves), plan_file),
+    elif engine is not None:
+        existed, failed = apply_plan(plan, engine)
+    print_plan(plan, existed, failed)
+    return plan
+
+# inotify(7) constants, from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x80000
+
+class Inotify(object):
+    # just enough inotify through ctypes, linux only
+    def __init__(self):
+        from ctypes import CDLL
+        from ctypes.util import find_library
+        self.libc = CDLL(find_library('c'), use_errno = True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            self.raise_errno()
+
+    def raise_errno(self, path = None):
+        from ctypes import get_errno
+        from os import strerror
+        e = get_errno()
+        raise OSError(e, strerror(e), path)
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, path, mask | IN_ONLYDIR)
+        if wd < 0:
+            self.raise_errno(path)
+        return wd
+
+    def read(self):
+        # yields (wd, mask, name)
+        from os import read
+        from struct import unpack_from
+        buf = read(self.fd, 0x10000)
+        i = 0
+        while i < len(buf):
+            wd, mask, cookie, length = unpack_from('iIII', buf, i)
+            i += 16
+            yield wd, mask, buf[i:i + length].rstrip('\0')
+            i += length
+
+SRC_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MODIFY
+DST_MASK = IN_CREATE | IN_MOVED_TO
+
+def watch(src_dir, dst_dir, overwrite_existing = False, dry_run = True,
+        cache_file = None, rebuild_cache = False, jobs = 8, journal_file = None, copy_jobs = 2,
+        debounce = .2):
+    # build the rules once, then catalog files as they're finished in src_dir,
+    # new manual rule dirs and new files under dst_dir update the rules in place
+    from select import poll, POLLIN
+    from time import time
+
+    inotify = Inotify()
+    # watch first, so nothing slips through between the initial pass and the loop
+    src_wd = inotify.add_watch(src_dir, SRC_MASK)
+    dst_wd = inotify.add_watch(dst_dir, DST_MASK)
+    bangumi_wds = {}
+    def watch_bangumi(bangumi):
+        bangumi_full = join(dst_dir, bangumi)
+        try:
+            bangumi_wds[inotify.add_watch(bangumi_full, DST_MASK)] = bangumi_full
+        except OSError, e:
+            print >> stderr, 'can\'t watch %s: %s\n' % (bangumi_full, e.strerror),
+    for bangumi, is_dir, _ in list_dir(dst_dir):
+        if is_dir:
+            watch_bangumi(bangumi)
+
+    engine = None
+    if not dry_run:
+        engine = MoveEngine(journal_file, copy_jobs)
+        engine.resume()
+    index = generate_rules(dst_dir, cache_file, rebuild_cache, jobs, dry_run)
+    if index is None:
+        index = RuleIndex({}, {})
+
+    # filename -> when it's considered finished, a write pushes it back
+    pending = {}
+    def schedule_all():
+        now = time()
+        for filename, _, is_file in list_dir(src_dir):
+            if is_file:
+                pending[filename] = now
+    schedule_all()
+
+    p = poll()
+    p.register(inotify.fd, POLLIN)
+    print 'watching %s\n' % src_dir,
+    while True:
+        now = time()
+        for filename, due in pending.items():
+            if due > now:
+                continue
+            del pending[filename]
+            if not isfile(join(src_dir, filename)):
+                continue
+            target, moved = catalog_file(index, engine, src_dir, filename, overwrite_existing, dry_run)
+            if target is None:
+                print 'no matching rule for %s\n' % filename,
+            elif not moved and not dry_run:
+                print '%s is not moved, we won\'t overwrite files\n' % filename,
+        timeout = None
+        if pending:
+            timeout = max(0, min(pending.values()) - time()) * 1000
+        if not p.poll(timeout):
+            continue
+        for wd, mask, name in inotify.read():
+            if mask & IN_IGNORED:
+                # the watched dir is gone
+                bangumi_wds.pop(wd, None)
+            elif mask & IN_Q_OVERFLOW:
+                # events were lost, fall back to a full look at src_dir
+                schedule_all()
+            elif wd == src_wd:
+                if mask & IN_ISDIR:
+                    continue
+                if mask & (IN_CLOSE_WRITE | IN_MOVED_TO) or name in pending:
+                    pending[name] = time() + debounce
+            elif wd == dst_wd:
+                if mask & IN_ISDIR:
+                    # a new bangumi, a dir moved in may come with files already
+                    watch_bangumi(name)
+                    bangumi_full = join(dst_dir, name)
+                    manual, auto = scan_bangumi(bangumi_full)
+                    for rule in manual:
+                        index.add_manual(name_key(rule), bangumi_full)
+                    for prefix in auto:
+                        index.add_auto(prefix, bangumi_full)
+            elif wd in bangumi_wds:
+                bangumi_full = bangumi_wds[wd]
+                if mask & IN_ISDIR:
+                    match = manual_rule_re.match(name)
+                    if match is not None:
+                        index.add_manual(name_key(match.group(1)), bangumi_full)
+                elif not name.endswith(PART_SUFFIX):
+                    # including files we just moved in
+                    prefix = get_prefix(name_key(name))
+                    if prefix is not None:
+                        index.add_auto(prefix, bangumi_full)
 
 if __name__ == '__main__':
     from sys import argv
+    if argv[1] == 'bench_prefix':
+        # auto-catalog.py bench_prefix [count]
+        raise SystemExit(not bench_prefix(*map(int, argv[2:3])))
     overwrite_existing = True
     dry_run = False
-    for arg in argv[3:]:
-        arg = arg.lower()
+    use_cache = True
+    rebuild_cache = False
+    jobs = 8
+    copy_jobs = 2
+    watch_mode = False
+    debounce = .2
+    plan_file = None
+    for arg_orig in argv[3:]:
+        arg = arg_orig.lower()
         if arg == 'no_overwrite':
             overwrite_existing = False
         elif arg == 'dry_run':
             dry_run = True
+        elif arg == 'no_cache':
+            use_cache = False
+        elif arg == 'rebuild_cache':
+            rebuild_cache = True
+        elif arg.startswith('jobs='):
+            jobs = int(arg[5:])
+        elif arg.startswith('copy_jobs='):
+            copy_jobs = int(arg[10:])
+        elif arg == 'watch':
+            watch_mode = True
+        elif arg.startswith('debounce='):
+            debounce = float(arg[9:])
+        elif arg.startswith('plan_json='):
+            # lower() is only for the keyword, keep the path as it is
+            plan_file = arg_orig[10:]
+    if argv[1] == 'apply':
+        # carry out a saved plan: auto-catalog.py apply plan.json [dry_run]
+        plan = Plan.load(argv[2])
+        overwrite_existing = plan.overwrite_existing
     print 'using CODEC: %s\n' % CODEC,
     print 'overwrite existing: %s\n' % overwrite_existing,
     print 'dry run: %s\n' % dry_run,
-    auto_catalog(argv[1], argv[2], overwrite_existing, dry_run)
-
+    if argv[1] == 'apply':
+        print 'applying plan with %d move(s):\n' % len(plan.moves),
+        for filename, target, kind, rule in plan.moves:
+            print '\t%s -> %s (%s rule: %s)\n' % (filename, target, kind, rule),
+        existed = failed = ()
+        if not dry_run:
+            engine = MoveEngine(join(plan.dst_dir, JOURNAL_NAME), copy_jobs)
+            if engine.resume():
+                engine.finish()
+            existed, failed = apply_plan(plan, engine)
+        print_plan(plan, existed, failed)
+    elif watch_mode:
+        cache_file = use_cache and join(argv[2], CACHE_NAME) or None
+        watch(argv[1], argv[2], overwrite_existing, dry_run, cache_file, rebuild_cache, jobs,
+            join(argv[2], JOURNAL_NAME), copy_jobs, debounce)
+    else:
+        cache_file = use_cache and join(argv[2], CACHE_NAME) or None
+        auto_catalog(argv[1], argv[2], overwrite_existing, dry_run, cache_file, rebuild_cache, jobs,
+            join(argv[2], JOURNAL_NAME), copy_jobs, plan_file)
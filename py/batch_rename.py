@@ -0,0 +1,159 @@
+# renames many files as a whole, shared by chkren and de-mangle:
+# - collisions are found before anything is touched, with one hash lookup per name
+# - chains (a -> b, b -> c) are done from their free end, cycles through a temporary name
+# - every rename done is appended to a journal, undo() puts them back in reverse
+
+import os
+from os.path import join, lexists, normcase
+from json import dumps, loads
+
+def os_rename(dir, src, dst):
+    try:
+        os.rename(join(dir, src), join(dir, dst))
+        return True
+    except OSError:
+        return False
+
+def os_exists(dir, name):
+    return lexists(join(dir, name))
+
+def depth(dir):
+    return len(filter(None, dir.replace('\\', '/').split('/')))
+
+class RenameBatch(object):
+    def __init__(self, journal_file = None, rename = os_rename, exists = os_exists):
+        self.journal_file = journal_file
+        self.rename = rename
+        self.exists = exists
+        # (dir, src, dst)
+        self.renames = []
+        self.journal = None
+
+    def key(self, dir, name):
+        # windows doesn't care about case, normcase knows that
+        return normcase(join(dir, name))
+
+    def add(self, dir, src, dst):
+        self.renames.append((dir, src, dst))
+
+    def check(self):
+        # drops every rename that would overwrite something, returns those as
+        # [(dir, src, dst, reason)]
+        by_src = {}
+        by_dst = {}
+        for r in self.renames:
+            by_src[self.key(r[0], r[1])] = r
+            by_dst.setdefault(self.key(r[0], r[2]), []).append(r)
+        bad = {}
+        for k, rs in by_dst.items():
+            if len(rs) > 1:
+                for r in rs:
+                    bad[r] = 'same new name as %d other(s)' % (len(rs) - 1)
+            elif k not in by_src and self.exists(rs[0][0], rs[0][2]):
+                bad[rs[0]] = 'already exists'
+        # a name whose rename was dropped stays, and blocks whatever was to
+        # take its place, and so on down the chain
+        queue = bad.keys()
+        while queue:
+            r = queue.pop()
+            for r2 in by_dst.get(self.key(r[0], r[1]), ()):
+                if r2 is not r and r2 not in bad:
+                    bad[r2] = '"%s" stays' % r[1]
+                    queue.append(r2)
+        self.renames = [r for r in self.renames if r not in bad]
+        return [r + (bad[r],) for r in sorted(bad.keys())]
+
+    def order(self):
+        # [[(dir, src, dst), ...]], deepest directories first so no rename moves
+        # a path another one still needs; each list has to be done in order and
+        # the rest of it skipped when one fails
+        by_src = dict((self.key(r[0], r[1]), r) for r in self.renames)
+        dsts = set(self.key(r[0], r[2]) for r in self.renames)
+        done = set()
+        steps = []
+        def chain(r):
+            chain = [r]
+            done.add(r)
+            next = by_src.get(self.key(r[0], r[2]))
+            while next is not None and next not in done:
+                chain.append(next)
+                done.add(next)
+                next = by_src.get(self.key(next[0], next[2]))
+            return chain, next
+        # chains start where no other rename wants the name, and are done from
+        # their end, whose new name is free
+        for r in self.renames:
+            if r not in done and self.key(r[0], r[1]) not in dsts:
+                steps.append(chain(r)[0][::-1])
+        # the rest are cycles, one of them steps aside first
+        for r in self.renames:
+            if r in done:
+                continue
+            c = chain(r)[0]
+            if len(c) == 1:
+                # only the case changes
+                steps.append(c)
+                continue
+            dir, src, dst = r
+            tmp = self.temp_name(dir, src, by_src)
+            steps.append([(dir, src, tmp)] + c[:0:-1] + [(dir, tmp, dst)])
+        steps.sort(key = lambda step: -depth(step[0][0]))
+        return steps
+
+    def temp_name(self, dir, name, by_src):
+        i = 0
+        while True:
+            tmp = u'%s.rename-%d' % (name, i)
+            if self.key(dir, tmp) not in by_src and not self.exists(dir, tmp):
+                return tmp
+            i += 1
+
+    def apply(self):
+        # [(dir, src, dst)] that failed or were skipped because of that
+        failed = []
+        if self.journal_file is not None:
+            self.journal = open(self.journal_file, 'ab')
+        try:
+            for step in self.order():
+                for i, (dir, src, dst) in enumerate(step):
+                    if not self.rename(dir, src, dst):
+                        failed.extend(step[i:])
+                        break
+                    self.log(dir, src, dst)
+        finally:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+        return failed
+
+    def log(self, dir, src, dst):
+        # one line per rename, flushed right away so a crash loses at most one
+        if self.journal is not None:
+            self.journal.write(dumps([dir, src, dst], separators = (',', ':')) + '\n')
+            self.journal.flush()
+
+def undo(journal_file, rename = os_rename, exists = os_exists):
+    # renames everything in journal_file back, newest first, then moves the
+    # journal out of the way so it's not undone twice; returns (undone, failed)
+    records = []
+    if not lexists(journal_file):
+        return 0, []
+    f = open(journal_file, 'rb')
+    try:
+        for l in f:
+            try:
+                records.append(loads(l))
+            except ValueError:
+                # torn last line, that rename may or may not have happened
+                pass
+    finally:
+        f.close()
+    failed = []
+    for dir, src, dst in reversed(records):
+        if exists(dir, src) or not rename(dir, dst, src):
+            failed.append((dir, src, dst))
+    done = journal_file + '.undone'
+    if lexists(done):
+        os.remove(done)
+    os.rename(journal_file, done)
+    return len(records) - len(failed), failed
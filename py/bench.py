@@ -0,0 +1,461 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+# how fast the tools in this directory are on made up workloads, to compare
+# commits: every scenario builds its own tree on tmpfs and runs in a child
+# process, so peak memory is its own; one json line per run:
+# {"scenario", "run", "commit", "params", "items", "wall_s", "cpu_s",
+#  "items_per_s", "base_rss_kb", "peak_rss_kb"}, or "error" instead
+#
+# bench.py [scenario ...] [name=value ...], all scenarios if none is named,
+# see PARAMS for names; a UTF-8 locale is needed, like the tools assume on
+# Linux; a run that didn't do all the work it was given is an "error"
+
+import os
+import sys
+from os.path import join, dirname, abspath, isdir
+from json import dumps, loads
+from random import Random
+from time import time, sleep
+from resource import getrusage, RUSAGE_SELF
+from shutil import copy, rmtree
+from subprocess import Popen, PIPE
+from tempfile import mkdtemp
+from traceback import format_exc
+import imp
+import codecs
+
+HERE = dirname(abspath(__file__))
+
+PARAMS = {
+    # auto-catalog: bangumi dirs in dst_dir, files in each, files in src_dir
+    'bangumis': 200,
+    'files': 20,
+    'src_files': 2000,
+    # chkren/de-mangle: a tree fanout dirs wide and depth deep, names files
+    # in each dir, dirty of all names need renaming
+    'depth': 5,
+    'fanout': 4,
+    'names': 20,
+    'dirty': .2,
+    # HDD_Monitor: disks, and seconds a smartctl call or an ioctl takes
+    'disks': 24,
+    'latency': .05,
+    'jobs': 8,
+    'repeat': 1,
+    'seed': 0,
+    # where trees are made, results are appended to out as well
+    'tmp': isdir('/dev/shm') and '/dev/shm' or '',
+    'out': '',
+}
+
+def load(name, path):
+    # the tools are scripts, some with a dash in their name
+    return imp.load_source(name, join(HERE, path))
+
+def write(path, content):
+    f = open(path, 'wb')
+    try:
+        f.write(content)
+    finally:
+        f.close()
+
+# auto-catalog
+
+def release(group, title, episode, r):
+    if r.random() < .5:
+        return u'[%s][%s][%02d][%s].mkv' % (group, title, episode, r.choice((u'1080P', u'720p', u'BIG5')))
+    return u'【%s】%s - %02d【%s】.mp4' % (group, title, episode, r.choice((u'1080p', u'HEVC-10bit')))
+
+def auto_catalog_tree(root, p):
+    # dst_dir with a few manual rule dirs, src_dir with files for about every
+    # bangumi and some that match nothing; returns (src_dir, dst_dir, files)
+    r = Random(p['seed'])
+    src, dst = join(root, 'src'), join(root, 'dst')
+    os.mkdir(src)
+    os.mkdir(dst)
+    shows = []
+    for i in xrange(p['bangumis']):
+        group = r.choice((u'Grp%d' % (i % 17), u'字幕组%d' % (i % 13)))
+        title = r.choice((u'Title %d' % i, u'タイトル%d' % i))
+        bangumi = join(dst, (u'%s %s' % (group, title)).encode('utf-8'))
+        os.mkdir(bangumi)
+        if i % 10 == 0:
+            os.mkdir(join(bangumi, (u'prefix=[%s] %s' % (group, title)).encode('utf-8')))
+        for e in xrange(p['files']):
+            write(join(bangumi, release(group, title, e + 1, r).encode('utf-8')), '')
+        shows.append((group, title))
+    for i in xrange(p['src_files']):
+        if r.random() < .1:
+            name = u'homeless %d.mkv' % i
+        else:
+            group, title = r.choice(shows)
+            name = release(group, title, p['files'] + 1 + i % 50, r)
+        write(join(src, name.encode('utf-8')), '')
+    return src, dst, p['bangumis'] * p['files'] + p['src_files']
+
+class Sink(object):
+    # takes str and unicode alike, a file would want unicode encoded first
+    def write(self, s):
+        pass
+
+    def flush(self):
+        pass
+
+def quiet(f, *args):
+    # the tools print every file, that's not what is measured; whatever their
+    # children print goes to /dev/null
+    null = os.open(os.devnull, os.O_WRONLY)
+    saved = os.dup(1), os.dup(2)
+    streams = sys.stdout, sys.stderr
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(null, 1)
+    os.dup2(null, 2)
+    sys.stdout = sys.stderr = Sink()
+    try:
+        return f(*args)
+    finally:
+        sys.stdout, sys.stderr = streams
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        map(os.close, saved + (null,))
+
+def check_plan(src):
+    # every file in src_dir is somewhere in the plan, most of them moved;
+    # made up names can repeat, so they're counted, not taken from p
+    files = len(os.listdir(src))
+    def check(plan):
+        if plan is None:
+            return 'no rules'
+        planned = len(plan.moves) + len(plan.existed) + len(plan.homeless)
+        if planned != files or not plan.moves:
+            return '%d file(s) planned, %d move(s), expected %d' % (planned, len(plan.moves), files)
+    return check
+
+def bench_auto_catalog(root, p):
+    # one dry run, rules scanned from scratch
+    ac = load('auto_catalog', 'auto-catalog.py')
+    src, dst, items = auto_catalog_tree(root, p)
+    return items, lambda: quiet(ac.auto_catalog, src, dst, False, True, None, False, p['jobs']), check_plan(src)
+
+def bench_auto_catalog_cached(root, p):
+    # a dry run with the rule cache of the one before
+    ac = load('auto_catalog', 'auto-catalog.py')
+    src, dst, items = auto_catalog_tree(root, p)
+    cache = join(root, ac.CACHE_NAME)
+    # dirs changed just now aren't cached, the tree is made as old as a real one
+    old = time() - 3600
+    for bangumi in os.listdir(dst):
+        os.utime(join(dst, bangumi), (old, old))
+    # a dry run leaves the cache alone, a saved plan moves nothing and writes it
+    quiet(ac.auto_catalog, src, dst, False, False, cache, False, p['jobs'], None, 2, join(root, 'plan'))
+    return items, lambda: quiet(ac.auto_catalog, src, dst, False, True, cache, False, p['jobs']), check_plan(src)
+
+def bench_auto_catalog_move(root, p):
+    # files really moved, it's one file system so they're renames
+    ac = load('auto_catalog', 'auto-catalog.py')
+    src, dst, _ = auto_catalog_tree(root, p)
+    check_planned = check_plan(src)
+    def check(plan):
+        left = len(os.listdir(src))
+        if plan is not None and left != len(plan.existed) + len(plan.homeless):
+            return '%d file(s) left in src_dir, %d move(s) planned' % (left, len(plan.moves))
+        return check_planned(plan)
+    return len(os.listdir(src)), lambda: quiet(ac.auto_catalog, src, dst, False, False, None, False, p['jobs'],
+        join(root, ac.JOURNAL_NAME)), check
+
+# chkren and de-mangle
+
+# hiragana and katakana are in both cp932 and cp936, most names are these
+CLEAN = u'abcdefghijklmnopqrstuvwxyz0123456789 -_.' + \
+    u''.join(map(unichr, range(0x3041, 0x3094) + range(0x30a1, 0x30f7)))
+
+def tree(root, p, dirty_chars):
+    # fanout ** depth dirs or so, names made of CLEAN, the dirty ones with a
+    # character from dirty_chars; returns (path, names, dirty names)
+    r = Random(p['seed'])
+    dirty = [0]
+    def name(i):
+        n = [r.choice(CLEAN) for j in xrange(r.randint(6, 30))]
+        if r.random() < p['dirty']:
+            n[r.randrange(len(n))] = r.choice(dirty_chars)
+            dirty[0] += 1
+        # unique in its dir whatever it's renamed to
+        return (u'%d %s' % (i, u''.join(n))).strip().encode('utf-8')
+    count = 0
+    # no recursion, deep trees are what this is for
+    dirs = [(join(root, 'tree'), 0)]
+    os.mkdir(dirs[0][0])
+    while dirs:
+        dir, depth = dirs.pop()
+        for i in xrange(p['names']):
+            write(join(dir, name(i)), '')
+        count += p['names']
+        if depth < p['depth']:
+            for i in xrange(p['fanout']):
+                d = join(dir, name(p['names'] + i))
+                os.mkdir(d)
+                dirs.append((d, depth + 1))
+            count += p['fanout']
+    return join(root, 'tree').decode('utf-8'), count, dirty[0]
+
+def count_names(path):
+    return sum(len(dirs) + len(files) for _, dirs, files in os.walk(path))
+
+def chkren_tree(root, p):
+    # the code page tables are built in setup, and cached next to the cfg
+    progdir = join(root, 'chkren')
+    os.mkdir(progdir)
+    copy(join(HERE, 'chkren', 'cp932-cp936.cfg'), progdir)
+    module = load('chkren', join('chkren', 'chkren.py'))
+    cr = quiet(module.chkren, progdir, 932, 936)
+    path, count, dirty = tree(root, p, cr.incompatible_chars)
+    return cr, path, count, dirty
+
+def bench_chkren_plan(root, p):
+    cr, path, count, dirty = chkren_tree(root, p)
+    def check((plan, errors)):
+        if len(plan) != dirty or errors:
+            return '%d rename(s) planned, %d error(s), expected %d' % (len(plan), len(errors), dirty)
+    return count, lambda: cr.plan(path, True, True, p['jobs']), check
+
+def bench_chkren(root, p):
+    cr, path, count, dirty = chkren_tree(root, p)
+    def check(_):
+        # nothing lost, nothing left to rename
+        left, errors = cr.plan(path, True, True)
+        found = count_names(path)
+        if left or errors or found != count:
+            return '%d name(s) found, %d left to rename, %d error(s), expected %d' % (
+                found, len(left), len(errors), count)
+    # the journal is kept for undo, not in the tree
+    return count, lambda: quiet(cr.chkdir, path, True, True, False, p['jobs'], join(root, 'journal')), check
+
+def check_de_mangle(count, dirty):
+    def check(counts):
+        if counts['names'] != count or counts['renames'] != dirty or counts['failed'] \
+                or counts['undecodable'] or counts['undecodable_dirs'] or counts['errors']:
+            return 'expected %d name(s), %d rename(s), got %r' % (count, dirty, counts)
+    return check
+
+def bench_de_mangle_plan(root, p):
+    dm = load('de_mangle', 'de-mangle.py')
+    path, count, dirty = tree(root, p, u':*?"<>|')
+    return count, lambda: quiet(dm.de_mangle, path, True, p['jobs']), check_de_mangle(count, dirty)
+
+def bench_de_mangle(root, p):
+    dm = load('de_mangle', 'de-mangle.py')
+    path, count, dirty = tree(root, p, u':*?"<>|')
+    return count, lambda: quiet(dm.de_mangle, path, False, p['jobs']), check_de_mangle(count, dirty)
+
+# HDD_Monitor
+
+FAKE_SMARTCTL = '''#!/bin/sh
+# the last argument is the device
+dev="$(eval echo \\${$#})"; name="${dev##*/}"
+sleep %(latency)s
+echo "smartctl 7.2"
+case "$*" in *-iA*)
+echo "=== START OF INFORMATION SECTION ==="
+echo "Device Model:     FAKE DISK 4000"
+echo "Serial Number:    SN-$name"
+echo "Firmware Version: FW01"
+echo "User Capacity:    4,000,787,030,016 bytes [4.00 TB]"
+echo;;
+esac
+cat <<EOT
+=== START OF READ SMART DATA SECTION ===
+ID# ATTRIBUTE_NAME          FLAG     VALUE WORST THRESH TYPE      UPDATED  WHEN_FAILED RAW_VALUE
+  5 Reallocated_Sector_Ct   0x0033   100   100   010    Pre-fail  Always       -       0
+  9 Power_On_Hours          0x0032   090   090   000    Old_age   Always       -       9000
+ 10 Spin_Retry_Count        0x0013   100   100   097    Pre-fail  Always       -       0
+193 Load_Cycle_Count        0x0032   099   099   000    Old_age   Always       -       2000
+194 Temperature_Celsius     0x0022   036   040   000    Old_age   Always       -       36
+196 Reallocated_Event_Count 0x0032   100   100   000    Old_age   Always       -       0
+197 Current_Pending_Sector  0x0012   100   100   000    Old_age   Always       -       0
+198 Offline_Uncorrectable   0x0010   100   100   000    Old_age   Offline      -       0
+EOT
+'''
+
+SMART_ATTRS = {0x05: 0, 0x09: 9000, 0x0a: 0, 0xc1: 2000, 0xc2: 36, 0xc4: 0, 0xc5: 0, 0xc6: 0}
+
+def disk_name(i):
+    # sda ... sdz, sdaa ...
+    name = ''
+    i += 1
+    while i:
+        i, c = divmod(i - 1, 26)
+        name = chr(ord('a') + c) + name
+    return 'sd' + name
+
+def hdd_tree(root, p):
+    # what lsblk would have shown, as HDD_Monitor reads it from sysfs, raid6
+    # arrays of 4 disks in /proc/mdstat, and a smartctl taking latency seconds;
+    # returns HDD_Monitor's kwargs
+    sys_block = join(root, 'block')
+    names = [disk_name(i) for i in xrange(p['disks'])]
+    mdstat = ['Personalities : [raid6] [raid5] [raid4]\n']
+    for i, name in enumerate(names):
+        disk = join(sys_block, name)
+        os.makedirs(join(disk, 'device'))
+        os.makedirs(join(disk, name + '1'))
+        write(join(disk, 'size'), '7814037168\n')
+        write(join(disk, 'device', 'model'), 'FAKE DISK 4000\n')
+        write(join(disk, 'device', 'type'), '0\n')
+        write(join(disk, 'device', 'wwid'), 'naa.5000c500%08x\n' % i)
+        write(join(disk, name + '1', 'partition'), '1\n')
+    for i in xrange(0, len(names) - 3, 4):
+        md = 'md%d' % (i / 4)
+        members = names[i:i + 4]
+        os.makedirs(join(sys_block, md, 'slaves'))
+        for name in members:
+            write(join(sys_block, md, 'slaves', name + '1'), '')
+        mdstat.append('%s : active raid6 %s\n      7813774336 blocks super 1.2 level 6, 512k chunk,'
+            ' algorithm 2 [4/4] [UUUU]\n\n' % (md, ' '.join('%s1[%d]' % (n, j) for j, n in enumerate(members))))
+    mdstat.append('unused devices: <none>\n')
+    write(join(root, 'mdstat'), ''.join(mdstat))
+    smartctl = join(root, 'smartctl')
+    write(smartctl, FAKE_SMARTCTL % {'latency': p['latency']})
+    os.chmod(smartctl, 0755)
+    return {'smartctl': smartctl, 'sys_block': sys_block, 'mdstat': join(root, 'mdstat'),
+        # no diskstats, sampling them waits for a long enough window
+        'diskstats': join(root, 'diskstats'), 'jobs': p['jobs'], 'timeout': max(10, p['latency'] * 10)}
+
+def check_hdds(hddm, p):
+    # every disk answered in time
+    def check(_):
+        polled = [hdd for hdd, info in hddm.hdds.items() if 'Serial Number' in info and not info.get('TIMEOUT')]
+        if len(polled) != p['disks']:
+            return '%d of %d disk(s) polled' % (len(polled), p['disks'])
+    return check
+
+def bench_hdd_smartctl(root, p):
+    # one full report, every disk polled with smartctl -iA
+    hm = load('HDD_Monitor', 'HDD_Monitor.py')
+    hddm = hm.HDD_Monitor(**hdd_tree(root, p))
+    return p['disks'], lambda: list(hddm.report()), check_hdds(hddm, p)
+
+def bench_hdd_sg_io(root, p):
+    # the same over SG_IO, to fake disks that take as long to answer
+    hm = load('HDD_Monitor', 'HDD_Monitor.py')
+    class SlowFakeSgIo(hm.FakeSgIo):
+        def command(self, device, cdb, length, timeout):
+            sleep(p['latency'])
+            return hm.FakeSgIo.command(self, device, cdb, length, timeout)
+    kwargs = hdd_tree(root, p)
+    sg = join(root, 'sg')
+    for i in xrange(p['disks']):
+        hm.fake_disk(sg, disk_name(i), SMART_ATTRS, 'SN%04d' % i)
+    hddm = hm.HDD_Monitor(sg_io_fake = sg, **kwargs)
+    hddm.sg = SlowFakeSgIo(sg)
+    return p['disks'], lambda: list(hddm.report()), check_hdds(hddm, p)
+
+SCENARIOS = [
+    ('auto_catalog', bench_auto_catalog),
+    ('auto_catalog_cached', bench_auto_catalog_cached),
+    ('auto_catalog_move', bench_auto_catalog_move),
+    ('chkren_plan', bench_chkren_plan),
+    ('chkren', bench_chkren),
+    ('de_mangle_plan', bench_de_mangle_plan),
+    ('de_mangle', bench_de_mangle),
+    ('hdd_smartctl', bench_hdd_smartctl),
+    ('hdd_sg_io', bench_hdd_sg_io),
+]
+
+def measure(scenario, p):
+    # runs in the child, the tree is gone when this returns
+    root = mkdtemp(prefix = 'bench-', dir = p['tmp'] or None)
+    try:
+        items, run, check = dict(SCENARIOS)[scenario](root, p)
+        base = getrusage(RUSAGE_SELF)
+        t = time()
+        result = run()
+        wall = time() - t
+        used = getrusage(RUSAGE_SELF)
+        # not timed, a run that skipped work is fast but not comparable
+        error = check(result)
+    finally:
+        rmtree(root, True)
+    if error is not None:
+        return {'error': error}
+    return {
+        'items': items,
+        'wall_s': round(wall, 6),
+        'cpu_s': round(used.ru_utime + used.ru_stime - base.ru_utime - base.ru_stime, 6),
+        'items_per_s': round(items / wall, 1),
+        # kilobytes on linux
+        'base_rss_kb': base.ru_maxrss,
+        'peak_rss_kb': used.ru_maxrss,
+    }
+
+def run_forked(scenario, p):
+    # a fresh process for each run, its ru_maxrss is only this scenario's
+    r, w = os.pipe()
+    sys.stdout.flush()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        try:
+            result = measure(scenario, p)
+        except Exception:
+            result = {'error': format_exc()}
+        f = os.fdopen(w, 'wb')
+        f.write(dumps(result))
+        f.close()
+        os._exit(0)
+    os.close(w)
+    f = os.fdopen(r, 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    os.waitpid(pid, 0)
+    if not data:
+        return {'error': 'the child died without a result'}
+    return loads(data)
+
+def commit():
+    # what's being measured, None outside a git checkout
+    try:
+        p = Popen(['git', 'describe', '--always', '--dirty'], cwd = HERE, stdout = PIPE, stderr = PIPE)
+    except OSError:
+        return None
+    out, _ = p.communicate()
+    return p.returncode == 0 and out.strip() or None
+
+def bench(scenarios, p):
+    rev = commit()
+    params = dict((k, v) for k, v in p.items() if k not in ('tmp', 'out'))
+    out = p['out'] and open(p['out'], 'ab') or None
+    try:
+        for scenario in scenarios:
+            for i in xrange(p['repeat']):
+                result = dict(scenario = scenario, run = i, commit = rev, params = params)
+                result.update(run_forked(scenario, p))
+                line = dumps(result, sort_keys = True)
+                print line
+                if out is not None:
+                    out.write(line + '\n')
+                    out.flush()
+    finally:
+        if out is not None:
+            out.close()
+
+if __name__ == '__main__':
+    # the tools skip names they can't decode, that's no workload
+    if codecs.lookup(sys.getfilesystemencoding() or 'ascii').name != 'utf-8':
+        raise SystemExit('a UTF-8 locale is needed, the file system encoding is %s' % sys.getfilesystemencoding())
+    p = dict(PARAMS)
+    scenarios = []
+    for arg in sys.argv[1:]:
+        k, eq, v = arg.partition('=')
+        if not eq:
+            if k not in dict(SCENARIOS):
+                raise SystemExit('unknown scenario %s, one of: %s' % (k, ', '.join(s for s, _ in SCENARIOS)))
+            scenarios.append(k)
+        elif k not in p:
+            raise SystemExit('unknown parameter %s, one of: %s' % (k, ', '.join(sorted(p.keys()))))
+        else:
+            # the same type as the default
+            p[k] = type(PARAMS[k])(v)
+    bench(scenarios or [s for s, _ in SCENARIOS], p)
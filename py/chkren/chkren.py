@@ -4,44 +4,44 @@
 # chkren r3, rewritten in python
 
 import re
+import os
 import os.path
+import sys
+
+from mmap import mmap, ACCESS_READ
+from Queue import Queue
+from multiprocessing.pool import ThreadPool
+
+try:
+    from batch_rename import RenameBatch, undo, os_rename, os_exists
+except ImportError:
+    # it's one level up, next to de-mangle.py
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+    from batch_rename import RenameBatch, undo, os_rename, os_exists
 
 # since i don't wanna depend on the big pywin32 package ...
-from ctypes import windll, create_unicode_buffer, byref, c_int, POINTER
-from ctypes.wintypes import *
+try:
+    from ctypes import windll
+except ImportError:
+    # not on windows, code page tables come from python's codecs then
+    windll = None
+    try:
+        from os import scandir
+    except ImportError:
+        # python 2 needs the scandir package from PyPI
+        try:
+            from scandir import scandir
+        except ImportError:
+            scandir = None
 
 MAX_PATH_LEN = 32768
+# file names listed in one MessageBox at most
+CONFIRM_MAX_LINES = 50
+# what was renamed, in the directory chkren worked on unless told otherwise
+JOURNAL_NAME = '.chkren.journal'
 FILE_ATTRIBUTE_DIRECTORY = 0x10
-
-FindFirstFile = windll.kernel32.FindFirstFileW
-FindFirstFile.argtypes = (LPCWSTR, POINTER(WIN32_FIND_DATAW))
-FindFirstFile.restype = HANDLE
-
-FindNextFile = windll.kernel32.FindNextFileW
-FindNextFile.argtypes = (HANDLE, POINTER(WIN32_FIND_DATAW))
-FindNextFile.restype = BOOL
-
-FindClose = windll.kernel32.FindClose
-FindClose.argtypes = (HANDLE,)
-FindClose.restype = BOOL
-
-MoveFile = windll.kernel32.MoveFileW
-MoveFile.argtypes = (LPCWSTR, LPCWSTR)
-MoveFile.restype = BOOL
-
-WideCharToMultiByte = windll.kernel32.WideCharToMultiByte
-WideCharToMultiByte.argtypes = (UINT, DWORD, LPCWSTR, INT, LPSTR, INT, LPCSTR, POINTER(BOOL))
-WideCharToMultiByte.restype = INT
 WC_NO_BEST_FIT_CHARS = 0x400
 
-GetCurrentDirectory = windll.kernel32.GetCurrentDirectoryW
-GetCurrentDirectory.argtypes = (DWORD, LPWSTR)
-GetCurrentDirectory.restype = DWORD
-
-# i have to use MessageBox since print will crash for non-ACP characters...
-MessageBox = windll.user32.MessageBoxW
-MessageBox.argtypes = (HWND, LPCWSTR, LPCWSTR, UINT)
-MessageBox.restype = INT
 MB_OK = 0
 MB_OKCANCEL = 1
 MB_YESNO = 4
@@ -54,25 +54,114 @@ ID_CANCEL = 2
 ID_YES = 6
 ID_NO = 7
 
+if windll is not None:
+    from ctypes import create_unicode_buffer, byref, c_int, POINTER, WinError
+    from ctypes.wintypes import *
+
+    FindFirstFile = windll.kernel32.FindFirstFileW
+    FindFirstFile.argtypes = (LPCWSTR, POINTER(WIN32_FIND_DATAW))
+    FindFirstFile.restype = HANDLE
+    INVALID_HANDLE_VALUE = HANDLE(-1).value
+
+    FindNextFile = windll.kernel32.FindNextFileW
+    FindNextFile.argtypes = (HANDLE, POINTER(WIN32_FIND_DATAW))
+    FindNextFile.restype = BOOL
+
+    FindClose = windll.kernel32.FindClose
+    FindClose.argtypes = (HANDLE,)
+    FindClose.restype = BOOL
+
+    MoveFile = windll.kernel32.MoveFileW
+    MoveFile.argtypes = (LPCWSTR, LPCWSTR)
+    MoveFile.restype = BOOL
+
+    WideCharToMultiByte = windll.kernel32.WideCharToMultiByte
+    WideCharToMultiByte.argtypes = (UINT, DWORD, LPCWSTR, INT, LPSTR, INT, LPCSTR, POINTER(BOOL))
+    WideCharToMultiByte.restype = INT
+
+    GetCurrentDirectory = windll.kernel32.GetCurrentDirectoryW
+    GetCurrentDirectory.argtypes = (DWORD, LPWSTR)
+    GetCurrentDirectory.restype = DWORD
+
+    # i have to use MessageBox since print will crash for non-ACP characters...
+    MessageBox = windll.user32.MessageBoxW
+    MessageBox.argtypes = (HWND, LPCWSTR, LPCWSTR, UINT)
+    MessageBox.restype = INT
+
+    def list_dir(path):
+        # (files, dirs)
+        wfd = WIN32_FIND_DATAW()
+        hff = FindFirstFile(u'\\\\?\\' + path + u'\\*', byref(wfd))
+        files = []
+        dirs = []
+        if hff in (None, INVALID_HANDLE_VALUE):
+            raise WinError()
+        try:
+            while(True):
+                if wfd.cFileName not in (u'.', u'..'):
+                    if wfd.dwFileAttributes & FILE_ATTRIBUTE_DIRECTORY:
+                        dirs.append(wfd.cFileName)
+                    else:
+                        files.append(wfd.cFileName)
+                if not FindNextFile(hff, byref(wfd)):
+                    break
+        finally:
+            FindClose(hff)
+        return files, dirs
+
+    def rename(dir, src, dst):
+        return MoveFile(
+            u'\\\\?\\' + dir + u'\\' + src,
+            u'\\\\?\\' + dir + u'\\' + dst
+        ) != 0
+
+    def exists(dir, name):
+        return os.path.lexists(u'\\\\?\\' + dir + u'\\' + name)
+else:
+    # no such problem elsewhere
+    def MessageBox(hwnd, text, caption, flags):
+        print (u'%s\n\n%s' % (caption, text)).encode('utf-8')
+        if flags & MB_YESNO:
+            return raw_input('[y/N] ').lower().startswith('y') and ID_YES or ID_NO
+        return ID_OK
+
+    def list_dir(path):
+        # (files, dirs), symlinks to directories are files here, no loops,
+        # names that don't decode are left out, they can't be translated
+        files = []
+        dirs = []
+        if scandir is not None:
+            for e in scandir(path):
+                if not isinstance(e.name, unicode):
+                    continue
+                if e.is_dir(follow_symlinks = False):
+                    dirs.append(e.name)
+                else:
+                    files.append(e.name)
+        else:
+            for name in os.listdir(path):
+                if not isinstance(name, unicode):
+                    continue
+                full = os.path.join(path, name)
+                if os.path.isdir(full) and not os.path.islink(full):
+                    dirs.append(name)
+                else:
+                    files.append(name)
+        return files, dirs
+
+    rename = os_rename
+    exists = os_exists
+
 UTF8BOM = '\xef\xbb\xbf'
 
 # unfortunately iconv cp932/cp936 is not fully compatible with windows code pages
 def codec_test(u, cp):
     try:
-        s = u.encode(cp)
+        s = u.encode('cp%d' % cp)
         return True
     except:
         return False
 
-def find_incompatible_chars(from_code = 'cp932', to_code = 'cp936'):
-    all_uchars = map(unichr, range(1, 0x10000))
-    f_chars = filter(lambda c:codec_test(c, from_code), all_uchars)
-    t_chars = filter(lambda c:codec_test(c, to_code), all_uchars)
-    incompatible_chars = filter(
-        lambda c:codec_test(c, from_code) and not codec_test(c, to_code),
-        all_uchars)
-    print len(all_uchars), len(f_chars), len(t_chars), len(incompatible_chars)
-    
 # well, the win32 way
 def codec_test_win32(u, cp):
     used_default_char = c_int()
@@ -82,35 +171,133 @@ def codec_test_win32(u, cp):
         return False
     else:
         return True
-        
-def find_incompatible_chars_win32(from_code, to_code):
-    all_uchars = map(unichr, range(1, 0x10000))
-    # f_chars = filter(lambda c:codec_test_win32(c, from_code), all_uchars)
-    # t_chars = filter(lambda c:codec_test_win32(c, to_code), all_uchars)
-    incompatible_chars = filter(
-        lambda c:codec_test_win32(c, from_code) and not codec_test_win32(c, to_code),
-        all_uchars)
-    # print len(all_uchars), len(f_chars), len(t_chars), len(incompatible_chars)
-    # print u''.join(incompatible_chars)
-    return incompatible_chars
-
-def print_codepage(codepage, width = 0x10):
-    all_uchars = map(unichr, range(1, 0x10000))
-    chars = filter(lambda c:codec_test_win32(c, codepage), all_uchars)
-    d = u''
-    remain_chars = chars
-    while len(remain_chars) > 0:
-        d += u''.join(remain_chars[:width]) + '\n'
-        remain_chars = remain_chars[width:]
-    used_default_char = c_int()
-    c = WideCharToMultiByte(codepage, 0, d, len(d), None, 0, None, byref(used_default_char))
-    print len(all_uchars), len(chars), used_default_char.value
+
+# one bit for each of U+0000 - U+FFFF
+CODEPAGE_TABLE_SIZE = 0x10000 / 8
+
+# how a code page is tested, win32 only where there's windll
+CODEPAGE_BACKENDS = ('win32', 'codec')
+
+def check_backend(backend):
+    if backend not in CODEPAGE_BACKENDS:
+        raise ValueError('unknown backend %r, one of: %s' % (backend, ', '.join(CODEPAGE_BACKENDS)))
+    if backend == 'win32' and windll is None:
+        raise ValueError('the win32 backend is only available on windows')
+
+class CodepageTable():
+    # which characters a code page has, the 65535 tests it takes to find out
+    # are done once, then kept as cp<codepage>.<backend>.tbl in cache_dir
+    def __init__(self, codepage, cache_dir = None, backend = None):
+        self.codepage = codepage
+        self.backend = backend or (windll is not None and 'win32' or 'codec')
+        # before a table is built or a cache file named after it
+        check_backend(self.backend)
+        self.test = self.backend == 'win32' and codec_test_win32 or codec_test
+        self.table = None
+        path = None
+        if cache_dir is not None:
+            path = os.path.join(cache_dir, 'cp%d.%s.tbl' % (codepage, self.backend))
+            self.table = self.load(path)
+        if self.table is None:
+            self.table = self.build()
+            if path is not None:
+                self.save(path)
+
+    def load(self, path):
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            if os.fstat(f.fileno()).st_size != CODEPAGE_TABLE_SIZE:
+                return None
+            # the mapping outlives the file object
+            return mmap(f.fileno(), 0, access = ACCESS_READ)
+        finally:
+            f.close()
+
+    def build(self):
+        table = bytearray(CODEPAGE_TABLE_SIZE)
+        for o in xrange(1, 0x10000):
+            if self.test(unichr(o), self.codepage):
+                table[o >> 3] |= 1 << (o & 7)
+        return str(table)
+
+    def save(self, path):
+        try:
+            f = open(path + '.tmp', 'wb')
+            try:
+                f.write(self.table)
+            finally:
+                f.close()
+            if os.path.exists(path):
+                # windows won't rename over it
+                os.remove(path)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError):
+            # read only, it's built again next time
+            pass
+
+    def __contains__(self, c):
+        o = ord(c)
+        return o < 0x10000 and ord(self.table[o >> 3]) >> (o & 7) & 1 == 1
+
+    def encodable(self, u):
+        for c in u:
+            if c not in self:
+                return False
+        return True
+
+    def chars(self, without = None):
+        # all characters in this code page, or just those absent in without
+        chars = []
+        for i in xrange(CODEPAGE_TABLE_SIZE):
+            b = ord(self.table[i])
+            if without is not None:
+                b &= ~ord(without.table[i])
+            if b:
+                for bit in xrange(8):
+                    if b >> bit & 1:
+                        chars.append(unichr(i << 3 | bit))
+        return chars
+
+def find_incompatible_chars(from_code, to_code, cache_dir = None, backend = None):
+    # characters that present in from_code but absent in to_code
+    return CodepageTable(from_code, cache_dir, backend).chars(
+        CodepageTable(to_code, cache_dir, backend))
+
+def print_codepage(codepage, width = 0x10, cache_dir = None, backend = None):
+    chars = CodepageTable(codepage, cache_dir, backend).chars()
+    d = u''.join(u''.join(chars[i:i + width]) + u'\n' for i in xrange(0, len(chars), width))
+    if windll is not None:
+        used_default_char = c_int()
+        c = WideCharToMultiByte(codepage, 0, d, len(d), None, 0, None, byref(used_default_char))
+        print 0xffff, len(chars), used_default_char.value
+    else:
+        print 0xffff, len(chars)
     return d
 
+def char_class(ords):
+    # a regex matching any one of ords, consecutive ones as ranges
+    ords = sorted(ords)
+    if not ords:
+        return u'(?!)'
+    escape = lambda o: (unichr(o) in u'\\]^-' and u'\\' or u'') + unichr(o)
+    ranges = []
+    first = last = ords[0]
+    for o in ords[1:] + [None]:
+        if o == last + 1:
+            last = o
+            continue
+        ranges.append(first == last and escape(first) or escape(first) + u'-' + escape(last))
+        if o is not None:
+            first = last = o
+    return u'[%s]' % u''.join(ranges)
+
 class chkren():
     cfg_re = re.compile(r'^(.*)\(0x([0-9A-F]{4})\)->(.*)$')
     
-    def __init__(self, progdir, fcode, tcode, verbose = False):
+    def __init__(self, progdir, fcode, tcode, verbose = False, backend = None):
         try:
             cfg = open(os.path.join(progdir, 'cp%d-cp%d.cfg' % (fcode, tcode)), 'r').read()
         except:
@@ -119,7 +306,8 @@ class chkren():
         if cfg[:3] != UTF8BOM:
             MessageBox(0, u'config file must be utf-8 encoded', u'Error', MB_ICONEXCLAMATION)
             return
-        self.incompatible_chars = find_incompatible_chars_win32(fcode, tcode)
+        to_table = CodepageTable(tcode, progdir, backend)
+        self.incompatible_chars = CodepageTable(fcode, progdir, backend).chars(to_table)
         self.trans0 = {}
         self.trans1 = dict(zip(map(ord, self.incompatible_chars), [None] * len(self.incompatible_chars)))
         for l in map(lambda l:l.strip(), cfg[3:].decode('utf-8').split('\n')):
@@ -135,7 +323,7 @@ class chkren():
                     MB_ICONEXCLAMATION
                 )
                 continue
-            if not codec_test_win32(str1, tcode):
+            if not to_table.encodable(str1):
                 MessageBox(
                     0,
                     u'invalid config line ignored: %s\n\nReason:\n\t%s absent in cp%d' %(l, str1, tcode),
@@ -153,6 +341,11 @@ class chkren():
         
         self.trans2 = dict(zip(self.trans1.keys(), [u' '] * len(self.trans1)))
         
+        # what trans() really uses, trans0 and trans2 in one
+        self.table = dict(self.trans2)
+        self.table.update(self.trans0)
+        self.incompatible_re = re.compile(char_class(self.table.keys()))
+        
         self.missing_chars = self.trans1.keys()
         self.missing_chars.sort()
         
@@ -175,56 +368,144 @@ class chkren():
         )
     
     def trans(self, src):
-        s0 = src.translate(self.trans0)
-        return len(s0) - len(s0.translate(self.trans1)), s0.translate(self.trans2)
+        # (characters replaced by space, new name, characters replaced)
+        # most names have nothing to replace, they're just searched once
+        if self.incompatible_re.search(src) is None:
+            return 0, src, ()
+        hits = []
+        def replace(m):
+            c = m.group()
+            hits.append(c)
+            return self.table[ord(c)]
+        dst = self.incompatible_re.sub(replace, src)
+        return len([c for c in hits if ord(c) in self.trans1]), dst, tuple(hits)
     
-    def chkdir(self, path, recursive = False, rename_dirs_too = False, verbose = False):
+    def plan(self, path, recursive = False, rename_dirs_too = False, jobs = 8):
+        # ([(depth, directory, name, new name, spaces)], [(directory, error)]),
+        # deepest first, so renaming in that order never moves a path that's
+        # still to be renamed
+        plan = []
+        errors = []
+        results = Queue()
+        def list_one(dir, depth):
+            # anything uncaught would leave the loop below waiting forever
+            try:
+                results.put((dir, depth, list_dir(dir), None))
+            except Exception, e:
+                results.put((dir, depth, None, e))
+        # directories are listed on the pool as soon as they're found, no
+        # recursion, so no limit on depth either
+        pool = ThreadPool(max(1, jobs))
+        pool.apply_async(list_one, (path, 0))
+        pending = 1
+        while pending > 0:
+            dir, depth, listing, e = results.get()
+            pending -= 1
+            if e is not None:
+                errors.append((dir, e))
+                continue
+            files, dirs = listing
+            for name in rename_dirs_too and files + dirs or files:
+                spaces, new_name, _ = self.trans(name)
+                if new_name != name:
+                    plan.append((depth, dir, name, new_name, spaces))
+            if recursive:
+                for d in dirs:
+                    pool.apply_async(list_one, (os.path.join(dir, d), depth + 1))
+                    pending += 1
+        pool.close()
+        plan.sort(key = lambda p: -p[0])
+        return plan, errors
+
+    def chkdir(self, path, recursive = False, rename_dirs_too = False, verbose = False, jobs = 8, journal = None):
         if path == None:
-            p = create_unicode_buffer(MAX_PATH_LEN)
-            GetCurrentDirectory(MAX_PATH_LEN, p)
-            path = p.value
-        wfd = WIN32_FIND_DATAW()
-        hff = FindFirstFile(u'\\\\?\\' + path + u'\\*', byref(wfd))
-        files = []
-        dirs = []
-        while(True):
-            if wfd.cFileName not in (u'.', u'..'):
-                if wfd.dwFileAttributes & FILE_ATTRIBUTE_DIRECTORY:
-                    dirs.append(wfd.cFileName)
-                else:
-                    files.append(wfd.cFileName)
-            if not FindNextFile(hff, byref(wfd)):
-                break
-        if rename_dirs_too:
-            files += dirs
-        if len(files) > 0:
-            spaces, new_names = zip(*map(self.trans, files))
-            spaces_used = sum(spaces)
-            pairs = filter(lambda p: p[0] != p[1], zip(files, new_names))
-            if len(pairs) > 0:
-                if verbose:
-                    msg = u'rename %d file(s)/directorie(s)?\n\n%s' % (
-                        len(pairs),
-                        u'\n'.join(map(u' -> '.join, pairs))
-                    )
-                    if spaces_used > 0:
-                        msg += u'\n\nCAUTION: %d character(s) is/are not specified in cfg file, use space instead' % spaces_used
-                    ret = MessageBox(0, msg, u'rename?', MB_YESNO | MB_ICONQUESTION)
-                else:
-                    ret = ID_YES
-                if ret == ID_YES:
-                    map(lambda p:
-                        MoveFile(
-                            u'\\\\?\\' + path + u'\\' + p[0],
-                            u'\\\\?\\' + path + u'\\' + p[1]
-                        ), pairs)
-        if len(dirs) > 0 and recursive:
-            if rename_dirs_too:
-                rename_dict = dict(pairs)
-                dirs == map(lambda d:rename_dict.get(d) or d, dirs)
-            for dir in dirs:
-                self.chkdir(path + u'\\' + dir)
-                
+            if windll is not None:
+                p = create_unicode_buffer(MAX_PATH_LEN)
+                GetCurrentDirectory(MAX_PATH_LEN, p)
+                path = p.value
+            else:
+                path = os.getcwdu()
+        elif not isinstance(path, unicode):
+            path = path.decode(sys.getfilesystemencoding())
+        plan, errors = self.plan(path, recursive, rename_dirs_too, jobs)
+        if len(plan) == 0:
+            if verbose and len(errors) > 0:
+                MessageBox(0, u'nothing to rename, but %d directorie(s) could not be read:\n\n%s' % (
+                        len(errors),
+                        u'\n'.join(u'%s: %s' % (dir, e) for dir, e in errors[:CONFIRM_MAX_LINES])
+                    ),
+                    u'Warning',
+                    MB_ICONEXCLAMATION
+                )
+            return
+        # nothing gets overwritten, renames that would are left out
+        batch = RenameBatch(journal or os.path.join(path, JOURNAL_NAME), rename, exists)
+        for p in plan:
+            batch.add(p[1], p[2], p[3])
+        skipped = batch.check()
+        # one confirmation for the whole tree
+        if verbose:
+            shown = sorted(plan, key = lambda p: (p[1], p[2]))[:CONFIRM_MAX_LINES]
+            msg = u'rename %d file(s)/directorie(s)?\n\n%s' % (
+                len(plan),
+                u'\n'.join(u'%s -> %s' % (os.path.relpath(os.path.join(p[1], p[2]), path), p[3]) for p in shown)
+            )
+            if len(plan) > len(shown):
+                msg += u'\n... and %d more' % (len(plan) - len(shown))
+            spaces_used = sum(p[4] for p in plan)
+            if spaces_used > 0:
+                msg += u'\n\nCAUTION: %d character(s) is/are not specified in cfg file, use space instead' % spaces_used
+            if len(errors) > 0:
+                msg += u'\n\nCAUTION: %d directorie(s) could not be read' % len(errors)
+            if len(skipped) > 0:
+                msg += u'\n\nCAUTION: %d of them will be skipped, the new name is taken:\n%s' % (
+                    len(skipped),
+                    u'\n'.join(u'%s -> %s: %s' % (os.path.relpath(os.path.join(s[0], s[1]), path), s[2], s[3])
+                        for s in skipped[:CONFIRM_MAX_LINES])
+                )
+            ret = MessageBox(0, msg, u'rename?', MB_YESNO | MB_ICONQUESTION)
+        else:
+            ret = ID_YES
+        if ret != ID_YES:
+            return
+        failed = batch.apply()
+        if verbose and len(failed) > 0:
+            MessageBox(0, u'%d of %d rename(s) failed:\n\n%s' % (
+                    len(failed),
+                    len(batch.renames),
+                    u'\n'.join(os.path.join(f[0], f[1]) for f in failed[:CONFIRM_MAX_LINES])
+                ),
+                u'Warning',
+                MB_ICONEXCLAMATION
+            )
+
+def bench_trans(cr, count = 200000, dirty_ratio = .05):
+    # trans() against the three translate() passes it replaced, on made up
+    # names that are mostly clean, like real directories
+    from random import Random
+    from time import time
+    r = Random(0)
+    clean = [c for c in map(unichr, range(0x20, 0x7f) + range(0x3041, 0x3094) + range(0x30a1, 0x30f7))
+        if c not in u'\\/:*?"<>|' and not cr.incompatible_re.search(c)]
+    dirty = cr.incompatible_chars
+    names = []
+    for i in xrange(count):
+        name = [r.choice(clean) for j in xrange(r.randint(8, 40))]
+        if dirty and r.random() < dirty_ratio:
+            name[r.randrange(len(name))] = r.choice(dirty)
+        names.append(u''.join(name))
+    def trans3(src):
+        s0 = src.translate(cr.trans0)
+        return len(s0) - len(s0.translate(cr.trans1)), s0.translate(cr.trans2)
+    results = []
+    for label, f in (('translate x3', trans3), ('trans', cr.trans)):
+        t = time()
+        results.append([f(name)[:2] for name in names])
+        t = time() - t
+        print '%s: %.3fs, %d names/s' % (label, t, count / t)
+    if results[0] != results[1]:
+        print 'results differ!'
+
 def chkren_main(*args):
     #default values
     action = 'chkren'
@@ -234,11 +515,17 @@ def chkren_main(*args):
     rename_dirs_too = False
     verbose = True
     path = None
+    jobs = 8
+    backend = None
+    journal = None
     
     progdir = os.path.dirname(args[0])
     
     if len(args) >= 2 and args[1] in ('print-codepage', 'p',
                                       'find-incompatible-chars', 'f',
+                                      'build-tables', 'b',
+                                      'undo', 'u',
+                                      'bench-trans',
                                       'chkren', 'c',
                                       '--help', '-h'):
         action = args[1]
@@ -252,6 +539,20 @@ def chkren_main(*args):
         elif args[i] in ('-t', '--to-codepage') and i + 1 < len(args):
             tcode = int(args[i + 1])
             i += 2
+        elif args[i] in ('-B', '--backend') and i + 1 < len(args):
+            backend = args[i + 1]
+            try:
+                check_backend(backend)
+            except ValueError, e:
+                MessageBox(0, unicode(e), u'Error', MB_ICONEXCLAMATION)
+                return
+            i += 2
+        elif args[i] in ('-J', '--journal') and i + 1 < len(args):
+            journal = os.path.abspath(args[i + 1])
+            i += 2
+        elif args[i] in ('-j', '--jobs') and i + 1 < len(args):
+            jobs = int(args[i + 1])
+            i += 2
         elif args[i] in ('-r', '--recursive'):
             recursive = True
             i += 1
@@ -266,38 +567,63 @@ def chkren_main(*args):
             i += 1
     
     if action in ('p', 'print-codepage'):
-        d = print_codepage(tcode)
+        d = print_codepage(tcode, cache_dir = progdir, backend = backend)
         f = open('cp%s.txt' % tcode, 'w')
         f.write(UTF8BOM)
         f.write(d.encode('utf-8'))
         f.close()
     elif action in ('f', 'find-incompatible-chars'):
-        ret = find_incompatible_chars_win32(fcode, tcode)
+        ret = find_incompatible_chars(fcode, tcode, progdir, backend)
         d = u'\n'.join(map(lambda c:u'%s(0x%04X)->' % (c, ord(c)), ret))
         f = open('cp%d-cp%d.log' % (fcode, tcode), 'w')
         f.write('\xef\xbb\xbf')
         f.write(d.encode('utf-8'))
         f.close()
+    elif action in ('b', 'build-tables'):
+        for cp in (fcode, tcode):
+            t = CodepageTable(cp, backend = backend)
+            t.save(os.path.join(progdir, 'cp%d.%s.tbl' % (cp, t.backend)))
+    elif action == 'bench-trans':
+        bench_trans(chkren(progdir, fcode, tcode, backend = backend))
     elif action in ('c', 'chkren'):
-        cr = chkren(progdir, fcode, tcode, verbose = True)
-        cr.chkdir(path, recursive, rename_dirs_too, verbose)
+        cr = chkren(progdir, fcode, tcode, verbose = True, backend = backend)
+        cr.chkdir(path, recursive, rename_dirs_too, verbose, jobs, journal)
+    elif action in ('u', 'undo'):
+        journal = journal or os.path.join(path or os.getcwd(), JOURNAL_NAME)
+        if not isinstance(journal, unicode):
+            journal = journal.decode(sys.getfilesystemencoding())
+        undone, failed = undo(journal, rename, exists)
+        MessageBox(0, u'%d rename(s) undone, %d failed%s' % (
+                undone,
+                len(failed),
+                u''.join(u'\n%s -> %s' % (os.path.join(f[0], f[2]), f[1]) for f in failed[:CONFIRM_MAX_LINES])
+            ),
+            u'undo',
+            len(failed) and MB_ICONEXCLAMATION or MB_ICONINFORMATION
+        )
     else:
         print 'chkren - rename files from one code page to another.\n' \
             '\tdue to programmer`s stupidity, ' \
             'there are still so many programs that won`t support unicode, ' \
             'that`s why chkren is born.\n\n' \
             'Usage:\n' \
-            '\t chkren.py [c|p|f] [-f fcode] [-t tcode] [-r] [-d] [-q] [path]\n\n' \
+            '\t chkren.py [c|u|p|f|b|bench-trans] [-f fcode] [-t tcode] [-B backend] [-j jobs] [-J journal] [-r] [-d] [-q] [path]\n\n' \
             'Options:\n' \
             '\tc, chkren\t\t\t(default)check and rename files\n' \
+            '\tu, undo\t\t\t\tundo every rename in the journal\n' \
             '\tp, print-codepage\t\tprint all available characters in tcode\n' \
             '\tf, find-incompatible-chars\tfind all characters that present in fcode but absent in tcode\n' \
+            '\tb, build-tables\t\t(re)build the fcode and tcode tables, they\'re built when first needed anyway\n' \
+            '\tbench-trans\t\t\tbenchmark renaming made up names\n' \
             '\t-f, --from-codepage\t\tspecify fcode\n' \
             '\t-t, --to-codepage\t\tspecify tcode\n' \
+            '\t-B, --backend\t\t\twin32 or codec(python\'s), default to win32 on windows\n' \
+            '\t-J, --journal\t\t\twhere renames are logged for undo, default to path\\%s\n' \
+            '\t-j, --jobs\t\t\tdirectories listed at the same time, default to 8\n' \
             '\t-r, --recursive\t\t\trecursively work on sub directories\n' \
             '\t-d, --rename-dirs-too\t\twork on directory names too\n' \
             '\t-q, --quiet\t\t\tdo not prompt for rename\n' \
-            '\tpath\t\t\t\tuse current directory if omitted'
+            '\tpath\t\t\t\tuse current directory if omitted' % JOURNAL_NAME
         return
     
 if __name__ == '__main__':
@@ -1,24 +1,139 @@
 #!/usr/bin/python
 # vim: set fileencoding=utf-8 :
 
-from os import listdir, rename
-from os.path import join
-from sys import argv
+from os import listdir
+from os.path import join, isdir, islink
+from sys import argv, getfilesystemencoding
+from re import compile as re_compile
+from time import time
+from Queue import Queue
+from multiprocessing.pool import ThreadPool
+try:
+	from os import scandir
+except ImportError:
+	# python 2 needs the scandir package from PyPI
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+from batch_rename import RenameBatch, undo
 
 # according to http://support.microsoft.com/kb/177506
 not_allowed = ur'\/:*?"<>|'
 translate = dict(zip([ord(c) for c in not_allowed], ur'＼／：＊？＂＜＞｜'))
+# one search per name, most of them have nothing to replace
+mangled = re_compile(u'[%s]' % u''.join(u'\\' + c for c in not_allowed)).search
+
+# what was renamed, for de-mangle.py undo PATH
+JOURNAL_NAME = '.de-mangle.journal'
+
+def list_dir(path):
+	# (names, dirs), symlinks to directories aren't followed
+	if scandir is not None:
+		names = []
+		dirs = []
+		for e in scandir(path):
+			names.append(e.name)
+			if e.is_dir(follow_symlinks = False):
+				dirs.append(e.name)
+		return names, dirs
+	names = listdir(path)
+	dirs = []
+	for n in names:
+		if isinstance(n, unicode):
+			full = join(path, n)
+		else:
+			# not decodable, joining it to a unicode path would try anyway
+			full = join(path.encode(getfilesystemencoding()), n)
+		if isdir(full) and not islink(full):
+			dirs.append(n)
+	return names, dirs
 
-path = argv[1].decode('utf-8')
+def walk(path, batch, jobs = 1):
+	# adds every rename under path to batch, returns counts
+	counts = {'dirs': 0, 'names': 0, 'undecodable': 0, 'undecodable_dirs': 0, 'errors': 0}
+	results = Queue()
+	def list_one(dir):
+		try:
+			results.put((dir, list_dir(dir), None))
+		except Exception, e:
+			results.put((dir, None, e))
+	# subdirectories are queued as soon as they're found, on a pool if asked
+	pool = jobs > 1 and ThreadPool(jobs) or None
+	def queue(dir):
+		if pool is not None:
+			pool.apply_async(list_one, (dir,))
+		else:
+			list_one(dir)
+	queue(path)
+	pending = 1
+	while pending > 0:
+		dir, listing, e = results.get()
+		pending -= 1
+		if e is not None:
+			print u'can\'t list "%s": %s\n' % (dir, e),
+			counts['errors'] += 1
+			continue
+		counts['dirs'] += 1
+		names, dirs = listing
+		counts['names'] += len(names)
+		for name in names:
+			if not isinstance(name, unicode):
+				# not utf-8, can't be translated
+				counts['undecodable'] += 1
+			elif mangled(name) is not None:
+				batch.add(dir, name, name.translate(translate))
+		for d in dirs:
+			if isinstance(d, unicode):
+				queue(join(dir, d))
+				pending += 1
+			else:
+				# and neither can anything under it
+				counts['undecodable_dirs'] += 1
+	if pool is not None:
+		pool.close()
+	return counts
 
-for filename in listdir(path):
-	need_rename = False
-	for c in filename:
-		if c in not_allowed:
-			print u'character \'%s\' is not allowed in "%s"\n' % (c, filename),
-			need_rename = True
-	if need_rename:
-		to_filename = filename.translate(translate)
-		print u'will rename "%s" to "%s"\n' % (filename, to_filename),
-		rename(join(path, filename), join(path, to_filename))
+def de_mangle(path, dry_run = False, jobs = 1):
+	started = time()
+	batch = RenameBatch(join(path, JOURNAL_NAME))
+	counts = walk(path, batch, jobs)
+	skipped = batch.check()
+	for dir, src, dst in sorted(batch.renames):
+		print u'%s "%s" to "%s"\n' % (dry_run and 'would rename' or 'will rename', join(dir, src), dst),
+	for dir, src, dst, reason in skipped:
+		print u'won\'t rename "%s" to "%s", %s\n' % (join(dir, src), dst, reason),
+	failed = []
+	if not dry_run:
+		failed = batch.apply()
+		for dir, src, dst in failed:
+			print u'failed to rename "%s" to "%s"\n' % (join(dir, src), dst),
+	print '%d dir(s), %d name(s), %d rename(s)%s, %d skipped, %d failed, %d undecodable, %d undecodable dir(s) not entered, %d unreadable dir(s), %.3fs' % (
+		counts['dirs'], counts['names'], len(batch.renames), dry_run and ' planned' or '',
+		len(skipped), len(failed), counts['undecodable'], counts['undecodable_dirs'], counts['errors'], time() - started)
+	counts.update(renames = len(batch.renames), skipped = len(skipped), failed = len(failed))
+	return counts
 
+if __name__ == '__main__':
+	# de-mangle.py [-n] [-j jobs] PATH, -n only shows what would be renamed
+	# de-mangle.py undo PATH
+	if argv[1] == 'undo':
+		undone, failed = undo(join(argv[2].decode('utf-8'), JOURNAL_NAME))
+		for dir, src, dst in failed:
+			print u'can\'t rename "%s" back to "%s"\n' % (join(dir, dst), src),
+		print '%d rename(s) undone, %d failed' % (undone, len(failed))
+		raise SystemExit
+	dry_run = False
+	jobs = 1
+	args = argv[1:]
+	while len(args) > 1:
+		if args[0] == '-n':
+			dry_run = True
+			args = args[1:]
+		elif args[0] == '-j':
+			jobs = int(args[1])
+			args = args[2:]
+		else:
+			break
+	de_mangle(args[0].decode('utf-8'), dry_run, jobs)